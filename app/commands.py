@@ -2,12 +2,65 @@
 Команды управления правилами через Telegram Saved Messages.
 """
 
+import asyncio
 import logging
-from telethon import events
+import re
+from typing import List, Optional, Tuple
+from telethon import events, utils
+from telethon.tl.types import Channel, Chat, User
 from .config_manager import ConfigManager
+from .matching import match_rules, get_unique_target_chats
+from .queue_manager import TELEGRAM_MESSAGE_LIMIT, utf16_len
 
 logger = logging.getLogger(__name__)
 
+# Паттерн команды (компилируется один раз при импорте)
+_CMD_RE = re.compile(r'^/\w+')
+# Команда целиком - до первого пробельного символа
+_CMD_TOKEN_RE = re.compile(r'\S+')
+
+# Лимит длины ответа на команду: ниже лимита Telegram, оставляем запас
+MAX_MESSAGE_LENGTH = TELEGRAM_MESSAGE_LIMIT - 96
+
+# Выполняющаяся перезагрузка конфигурации (общая для параллельных /reload)
+_reload_task: Optional[asyncio.Task] = None
+
+# Кэш описаний правил для /rules: (rules_version, [текст правила, ...])
+_rendered_rules: Tuple[Optional[int], List[str]] = (None, [])
+
+# Шаблон ответа на неизвестную команду
+_UNKNOWN_COMMAND_TEXT = (
+    "❌ Неизвестная команда: {command}\n\n"
+    "Используйте /help для списка команд"
+)
+
+# Текст справки (формируется один раз при импорте)
+_HELP_TEXT = """📖 **Справка по командам**
+
+**Просмотр:**
+`/rules` (`/list`) - список всех правил
+`/monitored_chats` - список мониторимых чатов  
+`/test <текст>` - проверить какие правила сработают
+
+**Управление правилами:**
+`/add_rule <правило>` - добавить/обновить правило
+`/delete_rule <имя>` - удалить правило
+`/add_chat` - добавить канал/группу в мониторинг (через Reply)
+
+**Формат /add_rule:**
+`название: слово1, слово2 -> ID_чата [case:on]`
+
+**Пример:**
+`/add_rule news: bitcoin, btc -> -1001234`
+
+**Системные:**
+`/reload` - перезагрузить config.json
+`/unblock_targets` - снять блокировку с целевых чатов (бан/запрет записи)
+`/help` - эта справка
+
+📚 Подробности в `USER_GUIDE.md`
+"""
+
 
 def setup_commands(client, config_mgr: ConfigManager) -> None:
     """
@@ -19,48 +72,24 @@ def setup_commands(client, config_mgr: ConfigManager) -> None:
         config_mgr: ConfigManager instance
     """
     
-    @client.on(events.NewMessage(from_users='me', pattern=r'^/\w+'))
+    @client.on(events.NewMessage(from_users='me', pattern=_CMD_RE))
     async def handle_commands(event):
         """Роутер команд управления"""
-        text = event.text.strip()
-        
         # Парсинг команды и аргументов
-        parts = text.split(maxsplit=1)
-        command = parts[0].lower()
-        args = parts[1] if len(parts) > 1 else ''
+        # Команда - всё до первого пробельного символа (пробел, таб, перевод строки)
+        text = event.text.strip()
+        match = _CMD_TOKEN_RE.match(text)
+        command = match.group().casefold()
+        args = text[match.end():].strip()
         
         try:
-            # Роутинг команд
-            if command == '/rules':
-                await cmd_list_rules(event, config_mgr)
-            
-            elif command == '/monitored_chats':
-                await cmd_monitored_chats(event, config_mgr)
-            
-            elif command == '/add_chat':
-                await cmd_add_chat(event, config_mgr)
-
-            elif command in ['/add_rule', '/edit_rule']:
-                await cmd_add_rule(event, config_mgr, args)
-
-            elif command == '/delete_rule':
-                await cmd_delete_rule(event, config_mgr, args)
-            
-            elif command == '/test':
-                await cmd_test_message(event, config_mgr, args)
-            
-            elif command == '/reload':
-                await cmd_reload(event, config_mgr)
-            
-            elif command == '/help':
-                await cmd_help(event)
-            
-            else:
+            # Роутинг команд через таблицу COMMANDS
+            handler = COMMANDS.get(command)
+            if handler is None:
                 # Неизвестная команда
-                await event.reply(
-                    f"❌ Неизвестная команда: {command}\n\n"
-                    f"Используйте /help для списка команд"
-                )
+                await event.reply(_UNKNOWN_COMMAND_TEXT.format(command=command))
+            else:
+                await handler(event, config_mgr, args)
         
         except Exception as e:
             logger.error(f"Ошибка выполнения команды {command}: {e}", exc_info=True)
@@ -69,35 +98,116 @@ def setup_commands(client, config_mgr: ConfigManager) -> None:
     logger.info("✅ Команды управления зарегистрированы")
 
 
-async def cmd_list_rules(event, config_mgr) -> None:
+def _pack_chunks(parts: List[str], limit: int = MAX_MESSAGE_LENGTH) -> List[str]:
+    """
+    Жадно упаковывает части ответа в сообщения не длиннее limit.
+    Части не разрываются, если сами не превышают лимит.
+    
+    Args:
+        parts: Части ответа в порядке вывода
+        limit: Максимальная длина сообщения (UTF-16)
+        
+    Returns:
+        Список текстов сообщений
+    """
+    chunks = []
+    buf = []
+    size = 0
+    
+    for part in parts:
+        part_len = utf16_len(part)
+        
+        # Слишком длинная часть режется на куски (символ - не больше 2 единиц UTF-16)
+        if part_len > limit:
+            step = limit // 2
+            pieces = [part[i:i + step] for i in range(0, len(part), step)]
+            pieces = [(piece, utf16_len(piece)) for piece in pieces]
+        else:
+            pieces = [(part, part_len)]
+        
+        for piece, piece_len in pieces:
+            if buf and size + piece_len > limit:
+                chunks.append(''.join(buf))
+                buf = []
+                size = 0
+            buf.append(piece)
+            size += piece_len
+    
+    if buf:
+        chunks.append(''.join(buf))
+    
+    return chunks
+
+
+async def _reply_chunks(event, parts: List[str]) -> None:
+    """Отправляет ответ одним или несколькими сообщениями, сохраняя порядок"""
+    chunks = _pack_chunks(parts)
+    if len(chunks) == 1:
+        await event.reply(chunks[0])
+        return
+    
+    # Чат резолвится один раз на весь многосоставной ответ
+    input_peer = await event.get_input_chat()
+    for chunk in chunks:
+        await event.client.send_message(input_peer, chunk, reply_to=event.id)
+
+
+def _render_rule(rule: dict) -> str:
+    """Форматирует описание правила для /rules (без номера)"""
+    name = rule.get('name', 'unnamed')
+    keywords = rule.get('keywords', [])
+    target_ids = rule.get('target_chat_ids', [])
+    case_sensitive = rule.get('case_sensitive', False)
+    
+    keywords_str = ', '.join(keywords)
+    targets_str = ', '.join(map(str, target_ids))
+    case_str = "⚠️ ВАЖЕН" if case_sensitive else "не важен"
+    
+    return (
+        f"**{name}**\n"
+        f"   📝 Ключевые слова: {keywords_str} ({len(keywords)})\n"
+        f"   📤 Целевые чаты: {targets_str} ({len(target_ids)})\n"
+        f"   🔤 Регистр: {case_str}\n\n"
+    )
+
+
+def _get_rendered_rules(config_mgr) -> List[str]:
+    """
+    Возвращает отформатированные описания правил.
+    Форматирование выполняется только после изменения правил (по rules_version).
+    """
+    global _rendered_rules
+    version, rendered = _rendered_rules
+    if version != config_mgr.rules_version:
+        rendered = [_render_rule(rule) for rule in config_mgr.get_rules()]
+        _rendered_rules = (config_mgr.rules_version, rendered)
+    return rendered
+
+
+async def cmd_list_rules(event, config_mgr, args: str = '') -> None:
     """Показывает список всех правил"""
-    rules = config_mgr.get_rules()
+    rendered = _get_rendered_rules(config_mgr)
     
-    if not rules:
+    if not rendered:
         await event.reply("📋 Нет активных правил")
         return
     
-    text = f"📋 Активные правила ({len(rules)}):\n\n"
+    parts = [f"📋 Активные правила ({len(rendered)}):\n\n"]
+    parts.extend(f"{i}️⃣ {block}" for i, block in enumerate(rendered, 1))
     
-    for i, rule in enumerate(rules, 1):
-        name = rule.get('name', 'unnamed')
-        keywords = rule.get('keywords', [])
-        target_ids = rule.get('target_chat_ids', [])
-        case_sensitive = rule.get('case_sensitive', False)
-        
-        keywords_str = ', '.join(keywords)
-        targets_str = ', '.join(str(id) for id in target_ids)
-        case_str = "⚠️ ВАЖЕН" if case_sensitive else "не важен"
-        
-        text += f"{i}️⃣ **{name}**\n"
-        text += f"   📝 Ключевые слова: {keywords_str} ({len(keywords)})\n"
-        text += f"   📤 Целевые чаты: {targets_str} ({len(target_ids)})\n"
-        text += f"   🔤 Регистр: {case_str}\n\n"
+    blocked = config_mgr.get_blocked_target_ids()
+    if blocked:
+        parts.append(
+            f"🚫 Заблокированные целевые чаты ({len(blocked)}): "
+            f"{', '.join(map(str, blocked))}\n"
+            f"Пересылка в них не выполняется. Снять блокировку: `/unblock_targets` "
+            f"или заново указать чат в `/add_rule`\n"
+        )
     
-    await event.reply(text)
+    await _reply_chunks(event, parts)
 
 
-async def cmd_monitored_chats(event, config_mgr) -> None:
+async def cmd_monitored_chats(event, config_mgr, args: str = '') -> None:
     """Показывает список мониторимых чатов"""
     monitored = config_mgr.config.get('monitored_chats', [])
     
@@ -105,19 +215,19 @@ async def cmd_monitored_chats(event, config_mgr) -> None:
         await event.reply("👁 Нет мониторимых чатов\n\nДобавьте бота в группу для автоматического добавления")
         return
     
-    text = f"👁 Мониторимые чаты ({len(monitored)}):\n\n"
+    parts = [f"👁 Мониторимые чаты ({len(monitored)}):\n\n"]
     
     for i, chat in enumerate(monitored, 1):
         chat_id = chat.get('id', 'Unknown')
         chat_name = chat.get('name', 'Unknown')
-        text += f"{i}. `{chat_id}` - \"{chat_name}\"\n"
+        parts.append(f"{i}. `{chat_id}` - \"{chat_name}\"\n")
     
-    text += "\n💡 Для использования в правилах копируйте chat_id"
+    parts.append("\n💡 Для использования в правилах копируйте chat_id")
     
-    await event.reply(text)
+    await _reply_chunks(event, parts)
 
 
-async def cmd_add_chat(event, config_mgr) -> None:
+async def cmd_add_chat(event, config_mgr, args: str = '') -> None:
     """
     Добавляет чат в monitored_chats через пересылку сообщения.
     Работает для групп И каналов!
@@ -132,59 +242,66 @@ async def cmd_add_chat(event, config_mgr) -> None:
         )
         return
     
+    # Получаем пересланное сообщение
+    reply_msg = await event.get_reply_message()
+    
+    # Проверяем откуда переслано
+    if reply_msg is None or not reply_msg.fwd_from:
+        await event.reply("❌ Это сообщение не является пересланным (или скрыт автор).")
+        return
+    
+    fwd_from = reply_msg.fwd_from
+    if not fwd_from.from_id and fwd_from.from_name:
+        logger.warning(f"cmd_add_chat: автор скрыл профиль ({fwd_from.from_name})")
+        await event.reply(f"❌ Не могу получить ID чата: автор скрыл свой профиль (имя: {fwd_from.from_name})")
+        return
+    
     try:
-        # Получаем пересланное сообщение
-        reply_msg = await event.get_reply_message()
-        
-        # Проверяем откуда переслано
-        if not reply_msg.fwd_from:
-            await event.reply("❌ Это сообщение не является пересланным (или скрыт автор).")
-            return
-
         # Пытаемся получить сущность оригинального чата
         # fwd_from.from_id может быть PeerChannel, PeerUser или PeerChat
-        if reply_msg.fwd_from.from_id:
-            chat = await event.client.get_entity(reply_msg.fwd_from.from_id)
-        elif reply_msg.fwd_from.from_name:
-            await event.reply(f"❌ Не могу получить ID чата: автор скрыл свой профиль (имя: {reply_msg.fwd_from.from_name})")
-            return
+        # utils.get_peer_id даёт корректный ID (с префиксом -100) без запросов к API
+        if fwd_from.from_id:
+            chat_id = utils.get_peer_id(fwd_from.from_id)
+            # Сущность обычно приходит вместе с сообщением - отдельный RPC не нужен
+            forward = reply_msg.forward
+            chat = (forward.chat or forward.sender) if forward else None
+            if chat is None:
+                chat = await event.client.get_entity(fwd_from.from_id)
         else:
             chat = await reply_msg.get_chat()
-            
-        # Используем utils.get_peer_id для получения корректного ID (с префиксом -100)
-        from telethon import utils
-        chat_id = utils.get_peer_id(chat)
+            chat_id = utils.get_peer_id(chat)
         
         # Получаем название
-        if hasattr(chat, 'title'):
+        if isinstance(chat, (Channel, Chat)):
             chat_name = chat.title
-        elif hasattr(chat, 'first_name'):
+        elif isinstance(chat, User):
             # Если переслано от пользователя - берем имя
-            last = getattr(chat, 'last_name', '') or ''
-            chat_name = f"{chat.first_name} {last}".strip()
+            chat_name = f"{chat.first_name or ''} {chat.last_name or ''}".strip() or 'Unknown'
         else:
             chat_name = 'Unknown'
         
         # Добавляем в monitored_chats
+        # Запись config.json откладывается ConfigManager и не блокирует event loop
         added = config_mgr.add_monitored_chat(chat_id, chat_name)
-        
-        if added:
-            await event.reply(
-                f"✅ **Чат добавлен в мониторинг!**\n\n"
-                f"📝 Название: {chat_name}\n"
-                f"🆔 Chat ID: `{chat_id}`\n\n"
-                f"💡 Чат активирован для всех правил"
-            )
-        else:
-            await event.reply(
-                f"ℹ️ **Чат уже в мониторинге**\n\n"
-                f"📝 Название: {chat_name}\n"
-                f"🆔 Chat ID: `{chat_id}`"
-            )
     
     except Exception as e:
         logger.error(f"Ошибка в cmd_add_chat: {e}", exc_info=True)
         await event.reply(f"❌ Ошибка: {e}")
+        return
+    
+    if added:
+        await event.reply(
+            f"✅ **Чат добавлен в мониторинг!**\n\n"
+            f"📝 Название: {chat_name}\n"
+            f"🆔 Chat ID: `{chat_id}`\n\n"
+            f"💡 Чат активирован для всех правил"
+        )
+    else:
+        await event.reply(
+            f"ℹ️ **Чат уже в мониторинге**\n\n"
+            f"📝 Название: {chat_name}\n"
+            f"🆔 Chat ID: `{chat_id}`"
+        )
 
 
 async def cmd_test_message(event, config_mgr, test_text: str) -> None:
@@ -193,10 +310,7 @@ async def cmd_test_message(event, config_mgr, test_text: str) -> None:
         await event.reply("❌ Использование: /test <текст сообщения>")
         return
     
-    from .handlers import check_message_against_rules, get_unique_target_chats
-    
-    rules = config_mgr.get_rules()
-    matched_rules = check_message_against_rules(test_text, rules)
+    matched_rules = match_rules(test_text, config_mgr.get_compiled_rules())
     
     if not matched_rules:
         await event.reply(f"🧪 Тест: \"{test_text}\"\n\n❌ Ни одно правило не сработало")
@@ -204,31 +318,60 @@ async def cmd_test_message(event, config_mgr, test_text: str) -> None:
     
     unique_chats = get_unique_target_chats(matched_rules)
     
-    text = f"🧪 Тест: \"{test_text}\"\n\n✅ Сработали правила:\n\n"
+    parts = [f"🧪 Тест: \"{test_text}\"\n\n✅ Сработали правила:\n\n"]
     
     for i, rule in enumerate(matched_rules, 1):
-        rule_name = rule['rule_name']
-        keyword = rule['matched_keyword']
-        targets = rule['target_chat_ids']
+        rule_name = rule.rule_name
+        keyword = rule.matched_keyword
+        targets = rule.target_chat_ids
         
-        text += f"{i}️⃣ **{rule_name}**\n"
-        text += f"   🎯 Совпало: \"{keyword}\"\n"
-        text += f"   📤 Отправится в: {', '.join(str(id) for id in targets)}\n\n"
+        parts.append(
+            f"{i}️⃣ **{rule_name}**\n"
+            f"   🎯 Совпало: \"{keyword}\"\n"
+            f"   📤 Отправится в: {', '.join(map(str, targets))}\n\n"
+        )
     
-    text += f"📊 Итого: {len(matched_rules)} правил, {len(unique_chats)} уникальных чатов"
+    parts.append(f"📊 Итого: {len(matched_rules)} правил, {len(unique_chats)} уникальных чатов")
     
-    await event.reply(text)
+    await _reply_chunks(event, parts)
+
+
+def _clear_reload_task(task: asyncio.Task) -> None:
+    """Сбрасывает ссылку на завершившуюся перезагрузку"""
+    global _reload_task
+    if _reload_task is task:
+        _reload_task = None
+
 
+async def _reload_config(config_mgr) -> bool:
+    """
+    Перечитывает конфигурацию (файл читается вне event loop, см. ConfigManager.reload).
+    Если перезагрузка уже выполняется, дожидается её вместо повторного чтения.
+    
+    Returns:
+        True если перезагрузку запустил этот вызов
+    """
+    global _reload_task
+    started = _reload_task is None
+    if started:
+        _reload_task = asyncio.create_task(config_mgr.reload())
+        _reload_task.add_done_callback(_clear_reload_task)
+    
+    # shield: отмена одного из ожидающих не прерывает общую перезагрузку
+    await asyncio.shield(_reload_task)
+    return started
 
-async def cmd_reload(event, config_mgr) -> None:
+
+async def cmd_reload(event, config_mgr, args: str = '') -> None:
     """Перечитывает конфигурацию с диска"""
     try:
-        config_mgr.load()
+        started = await _reload_config(config_mgr)
         rules_count = len(config_mgr.get_rules())
         monitored_count = len(config_mgr.config.get('monitored_chats', []))
+        status = "перезагружена" if started else "уже перезагружена"
         
         await event.reply(
-            f"✅ Конфигурация перезагружена\n\n"
+            f"✅ Конфигурация {status}\n\n"
             f"📊 Правил: {rules_count}\n"
             f"👁 Мониторимых чатов: {monitored_count}"
         )
@@ -236,6 +379,15 @@ async def cmd_reload(event, config_mgr) -> None:
         await event.reply(f"❌ Ошибка перезагрузки: {e}")
 
 
+async def cmd_unblock_targets(event, config_mgr, args: str = '') -> None:
+    """Снимает блокировку с целевых чатов, в которые не удавалось писать"""
+    count = config_mgr.clear_blocked_targets()
+    if count:
+        await event.reply(f"✅ Разблокировано целевых чатов: {count}")
+    else:
+        await event.reply("ℹ️ Заблокированных целевых чатов нет")
+
+
 async def cmd_add_rule(event, config_mgr, args: str) -> None:
     """
     Добавляет или редактирует правило через команду.
@@ -250,36 +402,37 @@ async def cmd_add_rule(event, config_mgr, args: str) -> None:
         )
         return
 
-    try:
-        # Используем существующий парсер из ConfigManager (он приватный, но мы можем его вызвать или продублировать логику)
-        # Для чистоты кода лучше если ConfigManager предоставит публичный метод парсинга или мы сами разберем здесь.
-        # Так как ConfigManager._parse_rule_line ожидает полную строку, соберем её.
-        rule_line = args.strip()
-        
-        # Минимальная проверка формата
-        if ':' not in rule_line or '->' not in rule_line:
-            # Если ввели просто имя, возможно хотят начать диалог? Но пользователь просил "по аналогии с /add_chat"
-            # /add_chat работает через пересылку. /add_rule пока сделаем через строку.
-            await event.reply("❌ Неверный формат. Используйте `name: keywords -> chat_id`")
-            return
-
-        parsed = config_mgr._parse_rule_line(rule_line)
-        if not parsed:
-            await event.reply("❌ Ошибка парсинга правила. Проверьте формат.")
-            return
+    # Используем существующий парсер из ConfigManager (он приватный, но мы можем его вызвать или продублировать логику)
+    # Для чистоты кода лучше если ConfigManager предоставит публичный метод парсинга или мы сами разберем здесь.
+    # Так как ConfigManager._parse_rule_line ожидает полную строку, соберем её.
+    rule_line = args.strip()
+    
+    # Минимальная проверка формата
+    if ':' not in rule_line or '->' not in rule_line:
+        # Если ввели просто имя, возможно хотят начать диалог? Но пользователь просил "по аналогии с /add_chat"
+        # /add_chat работает через пересылку. /add_rule пока сделаем через строку.
+        await event.reply("❌ Неверный формат. Используйте `name: keywords -> chat_id`")
+        return
+
+    # Парсер сообщает об ошибках формата через None, а не исключением
+    parsed = config_mgr._parse_rule_line(rule_line)
+    if not parsed:
+        await event.reply("❌ Ошибка парсинга правила. Проверьте формат.")
+        return
 
+    try:
         config_mgr.add_rule(
             name=parsed['name'],
             keywords=parsed['keywords'],
             target_chat_ids=parsed['target_chat_ids'],
             case_sensitive=parsed['case_sensitive']
         )
-        
-        await event.reply(f"✅ Правило **{parsed['name']}** успешно сохранено!")
-
     except Exception as e:
         logger.error(f"Ошибка в cmd_add_rule: {e}")
         await event.reply(f"❌ Ошибка: {e}")
+        return
+    
+    await event.reply(f"✅ Правило **{parsed['name']}** успешно сохранено!")
 
 
 async def cmd_delete_rule(event, config_mgr, args: str) -> None:
@@ -295,30 +448,23 @@ async def cmd_delete_rule(event, config_mgr, args: str) -> None:
         await event.reply(f"❌ Правило **{name}** не найдено")
 
 
-async def cmd_help(event) -> None:
+async def cmd_help(event, config_mgr=None, args: str = '') -> None:
     """Показывает справку по командам"""
-    help_text = """📖 **Справка по командам**
-
-**Просмотр:**
-`/rules` - список всех правил
-`/monitored_chats` - список мониторимых чатов  
-`/test <текст>` - проверить какие правила сработают
-
-**Управление правилами:**
-`/add_rule <правило>` - добавить/обновить правило
-`/delete_rule <имя>` - удалить правило
-`/add_chat` - добавить канал/группу в мониторинг (через Reply)
-
-**Формат /add_rule:**
-`название: слово1, слово2 -> ID_чата [case:on]`
-
-**Пример:**
-`/add_rule news: bitcoin, btc -> -1001234`
-
-**Системные:**
-`/reload` - перезагрузить config.json
-`/help` - эта справка
-
-📚 Подробности в `USER_GUIDE.md`
-"""
-    await event.reply(help_text)
+    await event.reply(_HELP_TEXT)
+
+
+# Таблица команд: имя команды (после casefold) -> обработчик.
+# Все обработчики имеют единую сигнатуру (event, config_mgr, args).
+COMMANDS = {
+    '/rules': cmd_list_rules,
+    '/list': cmd_list_rules,
+    '/monitored_chats': cmd_monitored_chats,
+    '/add_chat': cmd_add_chat,
+    '/add_rule': cmd_add_rule,
+    '/edit_rule': cmd_add_rule,
+    '/delete_rule': cmd_delete_rule,
+    '/test': cmd_test_message,
+    '/reload': cmd_reload,
+    '/unblock_targets': cmd_unblock_targets,
+    '/help': cmd_help,
+}
@@ -3,14 +3,72 @@
 Управление конфигурацией в формате JSON.
 """
 
+import asyncio
+import functools
+import itertools
 import json
 import logging
+import os
 import re
 from pathlib import Path
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, FrozenSet, Optional, Tuple
+
+from .matching import CompiledRule, compile_rules
 
 logger = logging.getLogger(__name__)
 
+# Задержка отложенного сохранения: серия изменений записывается одним файлом
+SAVE_DELAY = 0.5
+
+# Глобальный счётчик версий правил: версии уникальны между экземплярами
+_rules_versions = itertools.count(1)
+
+# Целевой чат в строке правила: chat_id "Название"
+_CHAT_ENTRY_RE = re.compile(r'(-?\d+)(?:\s+"([^"]+)")?')
+
+
+def _split_chat_entries(targets: str) -> List[str]:
+    """
+    Делит список целевых чатов по запятым вне кавычек.
+    Один линейный проход вместо regex с lookahead, который на длинных
+    строках многократно пересматривает хвост строки.
+    """
+    parts = []
+    buf = []
+    in_quotes = False
+    
+    for ch in targets:
+        if ch == '"':
+            in_quotes = not in_quotes
+        if ch == ',' and not in_quotes:
+            parts.append(''.join(buf))
+            buf.clear()
+        else:
+            buf.append(ch)
+    
+    parts.append(''.join(buf))
+    return parts
+
+
+@functools.lru_cache(maxsize=4096)
+def _correct_chat_id(chat_id: int) -> int:
+    """
+    Корректирует ID чата, добавляя префикс -100 для каналов и супергрупп,
+    если он отсутствует. Telethon использует маркированные ID.
+    Результат кэшируется: одни и те же ID повторяются во многих правилах.
+    """
+    chat_str = str(chat_id)
+    
+    # Если ID уже правильный (начинается на -100) - не трогаем
+    if chat_str.startswith('-100'):
+        return chat_id
+        
+    # Если чат отрицательный, но без -100 и длинный (обычно > 8 цифр)
+    if chat_id < 0 and len(chat_str) >= 11:
+        return int(f"-100{abs(chat_id)}")
+        
+    return chat_id
+
 
 class ConfigManager:
     """Менеджер конфигурации бота"""
@@ -31,30 +89,136 @@ class ConfigManager:
         self.config_file = config_file
         self.rules_file = rules_file
         self.config: Dict[str, Any] = {}
+        # Конфигурация загружается при первом обращении (см. _ensure_loaded)
+        self._loaded = False
+        # (st_mtime_ns, st_size) config.json на момент последней загрузки/сохранения
+        self._config_key: Optional[Tuple[int, int]] = None
+        # Содержимое, записанное последним сохранением
+        self._last_saved_payload: Optional[str] = None
+        # Отложенное сохранение (см. _schedule_save)
+        self._dirty = False
+        self._save_handle: Optional[asyncio.TimerHandle] = None
+        # Изменения, сделанные во время reload() (см. _record_for_reload)
+        self._reload_replay: Optional[List[Tuple[Any, Tuple]]] = None
+        # Кэши для горячего пути (пересобираются в _rebuild_caches при изменении)
+        self._compiled_rules: List[CompiledRule] = []
+        self._rules_cache: Tuple[Dict, ...] = ()
+        self._monitored_ids: FrozenSet[int] = frozenset()
+        self._all_target_ids: FrozenSet[int] = frozenset()
+        self._blocked_ids: FrozenSet[int] = frozenset()
+        self._rules_by_name: Dict[str, int] = {}
+        self._forward_mode = 'copy'
+        self._auto_add = True
+        # Меняется при каждой пересборке, позволяет кэшировать производные данные
+        self.rules_version = next(_rules_versions)
     
     def load(self) -> None:
         """Загружает конфигурацию из файлов"""
-        self._load_config_json()
+        loaded = self._read_config_file()
+        if loaded is None:
+            logger.info("Конфигурация не изменилась, повторная загрузка не требуется")
+            return
+        self._apply_config(*loaded)
+    
+    async def reload(self) -> None:
+        """
+        Перечитывает конфигурацию, не блокируя event loop.
+        В отдельном потоке выполняются только чтение и разбор config.json:
+        миграция, валидация, пересборка кэшей и запись остаются в event loop,
+        как и все остальные изменения конфигурации. Изменения, сделанные
+        во время чтения файла (новые чаты, блокировки), применяются поверх
+        прочитанной конфигурации.
+        """
+        # Несохранённые изменения записываются до чтения файла, иначе они потеряются
+        self.flush()
+        
+        self._reload_replay = []
+        try:
+            loaded = await asyncio.to_thread(self._read_config_file)
+            if loaded is None:
+                logger.info("Конфигурация не изменилась, повторная загрузка не требуется")
+                return
+            self._apply_config(*loaded)
+            replay = self._reload_replay
+        finally:
+            self._reload_replay = None
+        
+        for method, args in replay:
+            method(*args)
+    
+    def _record_for_reload(self, method, *args) -> None:
+        """Запоминает изменение, сделанное во время reload(), для повтора после загрузки"""
+        if self._reload_replay is not None:
+            self._reload_replay.append((method, args))
+    
+    def _read_config_file(self) -> Optional[Tuple[Optional[Tuple[int, int]], Optional[Dict[str, Any]]]]:
+        """
+        Читает config.json без изменения состояния менеджера (безопасно вызывать из потока).
+        
+        Returns:
+            None если файл не менялся с последней загрузки/сохранения и миграция не нужна,
+            иначе (ключ файла, разобранная конфигурация или None если файла нет)
+        """
+        key = self._config_file_key()
+        if (self._loaded and key is not None and key == self._config_key
+                and not Path(self.rules_file).exists()):
+            return None
+        return key, self._load_config_json()
+    
+    def _apply_config(self, key: Optional[Tuple[int, int]], data: Optional[Dict[str, Any]]) -> None:
+        """Применяет прочитанную конфигурацию: миграция, валидация, кэши"""
+        if data is None:
+            logger.warning(f"{self.config_file} не найден, создаём default")
+            self._create_default_config()
+        else:
+            self.config = data
+            # Содержимое файла могло быть изменено вручную - следующее сохранение
+            # не должно сравниваться с тем, что мы записывали раньше
+            self._last_saved_payload = None
         
         # Миграция из rules.txt если он есть
-        self._migrate_rules_if_needed()
+        changed = self._migrate_rules_if_needed()
+        changed = self._validate_and_clean() or changed
         
-        self._validate_and_clean()
-        self.save()
+        # config.json перезаписывается только если миграция или валидация его изменили
+        if changed:
+            self.save()
+        elif key is not None:
+            self._config_key = key
+        
+        self._rebuild_caches()
+        self._loaded = True
         logger.info("Конфигурация загружена успешно")
     
-    def _load_config_json(self) -> None:
-        """Загрузка config.json"""
+    def _ensure_loaded(self) -> None:
+        """Загружает конфигурацию при первом обращении"""
+        if not self._loaded:
+            self.load()
+    
+    def _load_config_json(self) -> Optional[Dict[str, Any]]:
+        """
+        Чтение и разбор config.json.
+        
+        Returns:
+            Конфигурация или None если файла нет
+        """
         try:
-            with open(self.config_file, 'r', encoding='utf-8') as f:
-                self.config = json.load(f)
+            # json.loads сам определяет кодировку байтов (UTF-8, в т.ч. с BOM)
+            return json.loads(Path(self.config_file).read_bytes())
         except FileNotFoundError:
-            logger.warning(f"{self.config_file} не найден, создаём default")
-            self._create_default_config()
+            return None
         except json.JSONDecodeError as e:
             logger.error(f"Ошибка парсинга {self.config_file}: {e}")
             raise
     
+    def _config_file_key(self) -> Optional[Tuple[int, int]]:
+        """Возвращает (mtime_ns, size) config.json или None, если файла нет"""
+        try:
+            st = os.stat(self.config_file)
+        except FileNotFoundError:
+            return None
+        return (st.st_mtime_ns, st.st_size)
+    
     def _create_default_config(self) -> None:
         """Создание конфигурации по умолчанию"""
         self.config = {
@@ -65,36 +229,39 @@ class ConfigManager:
         }
         self.save()
     
-    def _migrate_rules_if_needed(self) -> None:
+    def _migrate_rules_if_needed(self) -> bool:
         """
         Миграция правил из rules.txt в config.json.
         Выполняется один раз, после чего rules.txt переименовывается в rules.txt.bak.
+        
+        Returns:
+            True если в конфигурацию добавлены правила
         """
         rules_path = Path(self.rules_file)
         if not rules_path.exists():
-            return
+            return False
 
         logger.info(f"Обнаружен {self.rules_file}, начинаем миграцию правил...")
         
         rules = []
+        added_count = 0
         try:
-            with open(self.rules_file, 'r', encoding='utf-8') as f:
-                for line_num, line in enumerate(f, 1):
-                    line = line.strip()
-                    if not line or line.startswith('#'):
-                        continue
-                    try:
-                        rule = self._parse_rule_line(line)
-                        if rule:
-                            rules.append(rule)
-                    except Exception as e:
-                        logger.error(f"Ошибка миграции строки {line_num}: {e}")
+            lines = rules_path.read_text(encoding='utf-8').splitlines()
+            for line_num, line in enumerate(lines, 1):
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                try:
+                    rule = self._parse_rule_line(line)
+                    if rule:
+                        rules.append(rule)
+                except Exception as e:
+                    logger.error(f"Ошибка миграции строки {line_num}: {e}")
             
             if rules:
                 current_rules = self.config.get('rules', [])
                 current_names = {r.get('name') for r in current_rules}
                 
-                added_count = 0
                 for rule in rules:
                     if rule.get('name') not in current_names:
                         current_rules.append(rule)
@@ -115,6 +282,8 @@ class ConfigManager:
             
         except Exception as e:
             logger.error(f"Критическая ошибка при миграции правил: {e}")
+        
+        return added_count > 0
     
     
     def _parse_rule_line(self, line: str) -> Optional[Dict[str, Any]]:
@@ -135,6 +304,10 @@ class ConfigManager:
         
         # Разделяем на части
         name_part, rest = line.split(':', 1)
+        if '->' not in rest:
+            # Например "a -> b: c": стрелка стоит до двоеточия
+            logger.warning(f"Неверный формат строки: {line}")
+            return None
         keywords_part, targets_part = rest.split('->', 1)
         
         # Извлекаем опции
@@ -149,25 +322,25 @@ class ConfigManager:
             logger.warning("Пустое название правила")
             return None
         
-        # Парсим ключевые слова
-        keywords = [k.strip() for k in keywords_part.split(',') if k.strip()]
+        # Парсим ключевые слова (дубли убираются с сохранением порядка)
+        keywords = list(dict.fromkeys(k.strip() for k in keywords_part.split(',') if k.strip()))
         if not keywords:
             logger.warning(f"Правило '{name}': нет ключевых слов")
             return None
         
         # Парсим целевые чаты с названиями
         target_chat_ids = []
-        chat_entries = re.split(r',\s*(?=(?:[^"]*"[^"]*")*[^"]*$)', targets_part)
+        chat_entries = _split_chat_entries(targets_part)
         
         for entry in chat_entries:
             entry = entry.strip()
             if not entry:
                 continue
             
-            match = re.match(r'(-?\d+)(?:\s+"([^"]+)")?', entry)
+            match = _CHAT_ENTRY_RE.match(entry)
             if match:
                 chat_id_raw = match.group(1)
-                chat_id = self._correct_chat_id(int(chat_id_raw))
+                chat_id = _correct_chat_id(int(chat_id_raw))
                 target_chat_ids.append(chat_id)
             else:
                 logger.warning(f"Не удалось распарсить целевой чат: {entry}")
@@ -179,83 +352,150 @@ class ConfigManager:
         return {
             'name': name,
             'keywords': keywords,
-            'target_chat_ids': target_chat_ids,
+            'target_chat_ids': list(dict.fromkeys(target_chat_ids)),
             'case_sensitive': case_sensitive
         }
 
-    def _correct_chat_id(self, chat_id: int) -> int:
-        """
-        Корректирует ID чата, добавляя префикс -100 для каналов и супергрупп,
-        если он отсутствует. Telethon использует маркированные ID.
-        """
-        chat_str = str(chat_id)
-        
-        # Если ID уже правильный (начинается на -100) - не трогаем
-        if chat_str.startswith('-100'):
-            return chat_id
-            
-        # Если чат отрицательный, но без -100 и длинный (обычно > 8 цифр)
-        if chat_id < 0 and len(chat_str) >= 11:
-            return int(f"-100{abs(chat_id)}")
-            
-
-            
-        return chat_id
-    
-    def _validate_and_clean(self) -> None:
+    def _validate_and_clean(self) -> bool:
         """
         Валидация, коррекция ID и очистка от зацикливаний.
+        
+        Returns:
+            True если конфигурация была изменена
         """
-        # 1. Корректируем ID в правилах
-        for rule in self.config.get('rules', []):
-            rule['target_chat_ids'] = [self._correct_chat_id(id) for id in rule.get('target_chat_ids', [])]
-            
-        # 2. Корректируем ID в monitored_chats
-        monitored = self.config.get('monitored_chats', [])
-        for chat in monitored:
-            if isinstance(chat, dict) and 'id' in chat:
-                chat['id'] = self._correct_chat_id(chat['id'])
-            elif isinstance(chat, int):
-                # Старый формат (просто список ID)
-                pass # Это будет обработано ниже при перепаковке в словари
-                
-        # 3. Собираем все target чаты для защиты от зацикливания
+        changed = False
+        
+        # 1. Корректируем ID в правилах и собираем target чаты для защиты от зацикливания
         all_target_ids = set()
         for rule in self.config.get('rules', []):
-            all_target_ids.update(rule.get('target_chat_ids', []))
+            target_ids = rule.get('target_chat_ids', [])
+            # Дубли убираются: иначе одно сообщение пересылается в чат несколько раз
+            corrected = list(dict.fromkeys(_correct_chat_id(chat_id) for chat_id in target_ids))
+            if corrected != target_ids:
+                changed = True
+            rule['target_chat_ids'] = corrected
+            all_target_ids.update(corrected)
         
-        # 4. Фильтруем monitored_chats
+        # 2. Корректируем ID в monitored_chats и фильтруем target чаты
+        monitored = self.config.get('monitored_chats', [])
         cleaned = []
         removed_ids = []
         
         for chat in monitored:
             if isinstance(chat, dict):
+                if 'id' in chat:
+                    corrected_id = _correct_chat_id(chat['id'])
+                    if corrected_id != chat['id']:
+                        chat['id'] = corrected_id
+                        changed = True
                 chat_id = chat.get('id')
                 if chat_id not in all_target_ids:
                     cleaned.append(chat)
                 else:
                     removed_ids.append(chat_id)
             elif isinstance(chat, int):
-                corrected_id = self._correct_chat_id(chat)
+                # Старый формат (просто список ID) перепаковывается в словари
+                changed = True
+                corrected_id = _correct_chat_id(chat)
                 if corrected_id not in all_target_ids:
                     cleaned.append({'id': corrected_id, 'name': 'Unknown'})
                 else:
                     removed_ids.append(corrected_id)
         
         if removed_ids:
+            changed = True
             logger.warning(f"Удалены target чаты из monitored_chats: {removed_ids}")
         
+        if 'monitored_chats' not in self.config:
+            changed = True
         self.config['monitored_chats'] = cleaned
+        return changed
+
+    def _rebuild_caches(self) -> None:
+        """Пересобирает производные структуры после изменения конфигурации"""
+        rules = self.config.get('rules', [])
+        self._rules_cache = tuple(rules)
+        # При дублях имени используется первое правило (как при линейном поиске)
+        self._rules_by_name = {}
+        for i, rule in enumerate(rules):
+            self._rules_by_name.setdefault(rule.get('name'), i)
+        self._compiled_rules = compile_rules(rules)
+        self._all_target_ids = frozenset(
+            chat_id for rule in rules for chat_id in rule.get('target_chat_ids', [])
+        )
+        self._monitored_ids = frozenset(chat['id'] for chat in self.config.get('monitored_chats', []))
+        self._blocked_ids = frozenset(self.config.get('blocked_target_ids', []))
+        self._forward_mode = self.config.get('forward_mode', 'copy')
+        self._auto_add = self.config.get('auto_add_chats', True)
+        self.rules_version = next(_rules_versions)
 
     def save(self) -> None:
         """Сохраняет конфигурацию в config.json"""
-        self._save_config_json()
-        logger.info("Конфигурация сохранена")
+        if self._save_config_json():
+            logger.info("Конфигурация сохранена")
+
+    def _schedule_save(self) -> None:
+        """
+        Планирует сохранение после изменения конфигурации.
+        В event loop запись откладывается на SAVE_DELAY, и серия изменений
+        (например, добавление бота во много чатов подряд) даёт одну запись.
+        Без работающего event loop сохраняет сразу.
+        """
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()
+            return
+        
+        self._dirty = True
+        if self._save_handle is None:
+            self._save_handle = loop.call_later(SAVE_DELAY, self._deferred_flush)
+
+    def _deferred_flush(self) -> None:
+        """Отложенное сохранение из event loop: при ошибке записи повторяет попытку позже"""
+        self._save_handle = None
+        try:
+            self.flush()
+        except Exception as e:
+            logger.error(f"Ошибка сохранения {self.config_file}, повтор через {SAVE_DELAY}с: {e}")
+            self._schedule_save()
+
+    def flush(self) -> None:
+        """
+        Немедленно записывает отложенные изменения (например, при остановке).
+        При ошибке записи изменения остаются несохранёнными, исключение пробрасывается.
+        """
+        if self._save_handle is not None:
+            self._save_handle.cancel()
+            self._save_handle = None
+        
+        if self._dirty:
+            self.save()
+            self._dirty = False
 
-    def _save_config_json(self) -> None:
-        """Сохранение config.json"""
-        with open(self.config_file, 'w', encoding='utf-8') as f:
-            json.dump(self.config, f, indent=2, ensure_ascii=False)
+    def _save_config_json(self) -> bool:
+        """
+        Сохранение config.json.
+        Запись атомарная (временный файл + os.replace) и пропускается,
+        если содержимое не изменилось с последнего сохранения.
+        
+        Returns:
+            True если файл был записан
+        """
+        payload = json.dumps(self.config, indent=2, ensure_ascii=False)
+        
+        # Файл на диске всё ещё тот, что мы записали, и данные те же
+        if payload == self._last_saved_payload and self._config_file_key() == self._config_key:
+            return False
+        
+        tmp_file = f"{self.config_file}.tmp"
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(payload)
+        os.replace(tmp_file, self.config_file)
+        
+        self._last_saved_payload = payload
+        self._config_key = self._config_file_key()
+        return True
 
     def save_rules_to_file(self) -> None:
         """Заглушка (теперь всё хранится в config.json)"""
@@ -272,44 +512,131 @@ class ConfigManager:
         Returns:
             True если добавлен, False если уже существует или это target_chat
         """
-        # Проверка что это не target чат
-        all_target_ids = set()
-        for rule in self.config.get('rules', []):
-            all_target_ids.update(rule.get('target_chat_ids', []))
+        self._ensure_loaded()
         
-        if chat_id in all_target_ids:
+        # Проверка что это не target чат
+        if chat_id in self._all_target_ids:
             logger.warning(f"Чат {chat_id} является target_chat, не добавляем в monitored")
             return False
         
         # Проверка дубликатов
-        monitored = self.config.get('monitored_chats', [])
-        for chat in monitored:
-            if chat.get('id') == chat_id:
-                logger.info(f"Чат {chat_id} уже в monitored_chats")
-                return False
+        if chat_id in self._monitored_ids:
+            logger.info(f"Чат {chat_id} уже в monitored_chats")
+            return False
         
         # Добавляем
+        monitored = self.config.get('monitored_chats', [])
         monitored.append({'id': chat_id, 'name': chat_name})
         self.config['monitored_chats'] = monitored
-        self.save()
+        # Правила не менялись - пересборка кэшей не нужна
+        self._monitored_ids = self._monitored_ids | {chat_id}
+        self._record_for_reload(self.add_monitored_chat, chat_id, chat_name)
+        self._schedule_save()
         logger.info(f"Добавлен чат в monitored_chats: {chat_name} ({chat_id})")
         return True
     
     def get_monitored_chat_ids(self) -> List[int]:
         """Возвращает список ID мониторимых чатов"""
+        self._ensure_loaded()
         return [chat['id'] for chat in self.config.get('monitored_chats', [])]
     
-    def get_rules(self) -> List[Dict]:
-        """Возвращает список правил"""
-        return self.config.get('rules', [])
+    @property
+    def monitored_ids(self) -> FrozenSet[int]:
+        """ID мониторимых чатов (неизменяемое множество, без копирования)"""
+        self._ensure_loaded()
+        return self._monitored_ids
+    
+    def is_monitored_chat(self, chat_id: int) -> bool:
+        """Проверяет, мониторится ли чат (O(1), для обработчика сообщений)"""
+        self._ensure_loaded()
+        return chat_id in self._monitored_ids
+    
+    def get_rules(self) -> Tuple[Dict, ...]:
+        """Возвращает правила (неизменяемый снимок)"""
+        self._ensure_loaded()
+        return self._rules_cache
+    
+    def get_compiled_rules(self) -> List[CompiledRule]:
+        """Возвращает правила, скомпилированные для поиска"""
+        self._ensure_loaded()
+        return self._compiled_rules
     
     def get_forward_mode(self) -> str:
         """Возвращает режим пересылки"""
-        return self.config.get('forward_mode', 'copy')
+        self._ensure_loaded()
+        return self._forward_mode
     
     def get_auto_add_chats(self) -> bool:
         """Возвращает настройку автоматического добавления чатов"""
-        return self.config.get('auto_add_chats', True)
+        self._ensure_loaded()
+        return self._auto_add
+
+    def get_blocked_target_ids(self) -> List[int]:
+        """Возвращает список заблокированных целевых чатов"""
+        self._ensure_loaded()
+        return list(self.config.get('blocked_target_ids', []))
+
+    def is_blocked_target(self, chat_id: int) -> bool:
+        """Проверяет, заблокирован ли целевой чат (отправка туда запрещена)"""
+        self._ensure_loaded()
+        return chat_id in self._blocked_ids
+    
+    def block_target(self, chat_id: int) -> bool:
+        """
+        Запоминает целевой чат, в который нельзя писать (бан, запрет записи).
+        Очередь пропускает такие чаты без обращения к API.
+        
+        Args:
+            chat_id: ID целевого чата
+            
+        Returns:
+            True если добавлен, False если уже был заблокирован
+        """
+        self._ensure_loaded()
+        
+        if chat_id in self._blocked_ids:
+            return False
+        
+        self.config.setdefault('blocked_target_ids', []).append(chat_id)
+        self._blocked_ids = self._blocked_ids | {chat_id}
+        self._record_for_reload(self.block_target, chat_id)
+        self._schedule_save()
+        logger.warning(f"Целевой чат {chat_id} заблокирован для отправки")
+        return True
+    
+    def clear_blocked_targets(self) -> int:
+        """
+        Снимает блокировку со всех целевых чатов.
+        
+        Returns:
+            Количество разблокированных чатов
+        """
+        self._ensure_loaded()
+        
+        count = len(self._blocked_ids)
+        if count:
+            self.config['blocked_target_ids'] = []
+            self._blocked_ids = frozenset()
+            self._record_for_reload(self.clear_blocked_targets)
+            self._schedule_save()
+            logger.info(f"Разблокировано целевых чатов: {count}")
+        return count
+
+    def _unblock_rule_targets(self, name: str) -> None:
+        """
+        Снимает блокировку с целевых чатов правила: пользователь явно указал их заново
+        (например, после того как бота снова пустили в чат).
+        """
+        targets = self.config['rules'][self._rules_by_name[name]].get('target_chat_ids', [])
+        unblocked = self._blocked_ids.intersection(targets)
+        if not unblocked:
+            return
+        
+        self.config['blocked_target_ids'] = [
+            chat_id for chat_id in self.config.get('blocked_target_ids', []) if chat_id not in unblocked
+        ]
+        self._blocked_ids = self._blocked_ids - unblocked
+        logger.info(f"Разблокированы целевые чаты правила {name}: {sorted(unblocked)}")
 
     def add_rule(self, name: str, keywords: List[str], target_chat_ids: List[int], case_sensitive: bool = False) -> None:
         """
@@ -321,20 +648,22 @@ class ConfigManager:
             target_chat_ids: Список ID целевых чатов
             case_sensitive: Учитывать ли регистр
         """
+        self._ensure_loaded()
+        
         rules = self.config.get('rules', [])
         
-        # Ищем существующее правило
-        existing_rule = next((r for r in rules if r.get('name') == name), None)
+        # Ищем существующее правило по индексу имён
+        idx = self._rules_by_name.get(name)
         
         new_rule = {
             'name': name,
-            'keywords': keywords,
+            'keywords': list(dict.fromkeys(keywords)),
             'target_chat_ids': target_chat_ids,
             'case_sensitive': case_sensitive
         }
         
-        if existing_rule:
-            rules[rules.index(existing_rule)] = new_rule
+        if idx is not None:
+            rules[idx] = new_rule
             logger.info(f"Обновлено правило: {name}")
         else:
             rules.append(new_rule)
@@ -342,7 +671,13 @@ class ConfigManager:
             
         self.config['rules'] = rules
         self._validate_and_clean()  # Очистка и коррекция ID
-        self.save()                 # Сохраняем в config.json
+        self._rebuild_caches()
+        self._unblock_rule_targets(name)
+        self._record_for_reload(self.add_rule, name, keywords, target_chat_ids, case_sensitive)
+        # Правила меняются командой пользователя - пишем сразу,
+        # чтобы ошибка записи дошла до ответа на команду
+        self._dirty = True
+        self.flush()
 
     def remove_rule(self, name: str) -> bool:
         """
@@ -354,16 +689,18 @@ class ConfigManager:
         Returns:
             True если удалено, False если не найдено
         """
-        rules = self.config.get('rules', [])
-        original_len = len(rules)
-        
-        rules = [r for r in rules if r.get('name') != name]
+        self._ensure_loaded()
         
-        if len(rules) < original_len:
-            self.config['rules'] = rules
-            self.save()
-            logger.info(f"Удалено правило: {name}")
-            return True
+        if name not in self._rules_by_name:
+            logger.warning(f"Правило не найдено для удаления: {name}")
+            return False
         
-        logger.warning(f"Правило не найдено для удаления: {name}")
-        return False
+        # Удаляем все правила с этим именем (дубли возможны при ручной правке config.json)
+        rules = [r for r in self.config.get('rules', []) if r.get('name') != name]
+        self.config['rules'] = rules
+        self._rebuild_caches()
+        self._record_for_reload(self.remove_rule, name)
+        self._dirty = True
+        self.flush()
+        logger.info(f"Удалено правило: {name}")
+        return True
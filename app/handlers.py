@@ -5,7 +5,10 @@ ChatAction для автодобавления чатов, NewMessage для ф
 
 import logging
 from telethon import events
-from typing import List, Dict, Any
+
+from .matching import match_rules, get_unique_target_chats
+# Совместимость: функции сопоставления раньше жили в этом модуле
+from .matching import MatchedRule, CompiledRule, compile_rules, check_message_against_rules  # noqa: F401
 
 logger = logging.getLogger(__name__)
 
@@ -44,6 +47,7 @@ def setup_handlers(client, config_mgr, queue_mgr) -> None:
             logger.info(f"Бот добавлен в чат: {chat_name} ({chat_id})")
             
             # Добавляем в monitored_chats (с проверкой что это не target)
+            # Запись config.json откладывается: серия добавлений даёт одну запись
             added = config_mgr.add_monitored_chat(chat_id, chat_name)
             if added:
                 logger.info(f"✅ Чат {chat_name} добавлен в monitored_chats")
@@ -58,8 +62,7 @@ def setup_handlers(client, config_mgr, queue_mgr) -> None:
         Проверяет сообщения по правилам и добавляет в очередь при совпадении.
         """
         # Проверяем что это мониторимый чат
-        monitored_ids = config_mgr.get_monitored_chat_ids()
-        if event.chat_id not in monitored_ids:
+        if not config_mgr.is_monitored_chat(event.chat_id):
             return
         
         # Получаем текст сообщения
@@ -67,9 +70,8 @@ def setup_handlers(client, config_mgr, queue_mgr) -> None:
         if not text:
             return
         
-        # Проверяем по всем правилам
-        rules = config_mgr.get_rules()
-        matched_rules = check_message_against_rules(text, rules)
+        # Проверяем по всем правилам (скомпилированы при загрузке конфига)
+        matched_rules = match_rules(text, config_mgr.get_compiled_rules())
         
         if not matched_rules:
             return
@@ -78,8 +80,8 @@ def setup_handlers(client, config_mgr, queue_mgr) -> None:
         target_chats = get_unique_target_chats(matched_rules)
         
         # Логируем совпадения
-        rule_names = [r['rule_name'] for r in matched_rules]
-        matched_keywords = [r['matched_keyword'] for r in matched_rules]
+        rule_names = [r.rule_name for r in matched_rules]
+        matched_keywords = [r.matched_keyword for r in matched_rules]
         logger.info(
             f"✨ Сообщение совпало с правилами: {rule_names} "
             f"(ключевые слова: {matched_keywords})"
@@ -96,63 +98,3 @@ def setup_handlers(client, config_mgr, queue_mgr) -> None:
         queue_mgr.add_to_queue(message_data)
     
     logger.info("✅ Обработчики событий зарегистрированы")
-
-
-def check_message_against_rules(text: str, rules: List[Dict]) -> List[Dict[str, Any]]:
-    """
-    Проверяет текст по всем правилам.
-    
-    Args:
-        text: Текст сообщения
-        rules: Список правил
-        
-    Returns:
-        Список сработавших правил с информацией о совпадениях
-    """
-    if not text:
-        return []
-    
-    matched_rules = []
-    
-    for rule in rules:
-        keywords = rule.get('keywords', [])
-        case_sensitive = rule.get('case_sensitive', False)
-        
-        # Подготовка текста для поиска
-        check_text = text if case_sensitive else text.lower()
-        check_keywords = keywords if case_sensitive else [k.lower() for k in keywords]
-        
-        # Проверка совпадений
-        for keyword in check_keywords:
-            if keyword in check_text:
-                matched_rules.append({
-                    'rule_name': rule.get('name', 'unnamed'),
-                    'matched_keyword': keyword,
-                    'target_chat_ids': rule.get('target_chat_ids', [])
-                })
-                break  # Одного совпадения достаточно для правила
-    
-    return matched_rules
-
-
-def get_unique_target_chats(matched_rules: List[Dict]) -> List[int]:
-    """
-    Собирает уникальные target чаты из всех сработавших правил.
-    Дедупликация по ID чата.
-    
-    Args:
-        matched_rules: Список сработавших правил
-        
-    Returns:
-        Список уникальных chat_id
-    """
-    seen_ids = set()
-    unique_chats = []
-    
-    for rule in matched_rules:
-        for chat_id in rule['target_chat_ids']:
-            if chat_id not in seen_ids:
-                seen_ids.add(chat_id)
-                unique_chats.append(chat_id)
-    
-    return unique_chats
@@ -6,7 +6,8 @@ Telegram UserBot - Точка входа.
 import asyncio
 import logging
 import os
-from logging.handlers import RotatingFileHandler
+import queue
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
 
 from telethon import TelegramClient
@@ -60,7 +61,7 @@ async def main():
     
     # Информация о запуске
     rules_count = len(config_mgr.get_rules())
-    monitored_count = len(config_mgr.get_monitored_chat_ids())
+    monitored_count = len(config_mgr.monitored_ids)
     logger.info("="*50)
     logger.info("✨ Бот успешно запущен!")
     logger.info(f"📊 Правил: {rules_count}")
@@ -73,7 +74,11 @@ async def main():
     logger.info("="*50)
     
     # Запуск бота (блокирующий вызов)
-    await client.run_until_disconnected()
+    try:
+        await client.run_until_disconnected()
+    finally:
+        # Записываем отложенные изменения конфигурации
+        config_mgr.flush()
 
 
 if __name__ == '__main__':
@@ -81,21 +86,24 @@ if __name__ == '__main__':
     Path('app_data').mkdir(exist_ok=True)
 
     # Настройка логирования с ротацией
-    logging.basicConfig(
-        level=logging.INFO,
-        format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-        handlers=[
-            RotatingFileHandler(
-                'app_data/bot.log',
-                maxBytes=10*1024*1024,  # 10 MB
-                backupCount=5,
-                encoding='utf-8'
-            ),
-            logging.StreamHandler()
-        ]
+    formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    file_handler = RotatingFileHandler(
+        'app_data/bot.log',
+        maxBytes=10*1024*1024,  # 10 MB
+        backupCount=5,
+        encoding='utf-8'
     )
+    stream_handler = logging.StreamHandler()
+    file_handler.setFormatter(formatter)
+    stream_handler.setFormatter(formatter)
     
-
+    # Запись логов на диск/в консоль идёт в отдельном потоке и не блокирует event loop
+    log_queue = queue.SimpleQueue()
+    log_listener = QueueListener(log_queue, file_handler, stream_handler)
+    root_logger = logging.getLogger()
+    root_logger.setLevel(logging.INFO)
+    root_logger.addHandler(QueueHandler(log_queue))
+    log_listener.start()
     
     # Запуск бота
     try:
@@ -104,3 +112,6 @@ if __name__ == '__main__':
         logging.info("\n👋 Бот остановлен пользователем")
     except Exception as e:
         logging.error(f"❌ Критическая ошибка: {e}", exc_info=True)
+    finally:
+        # Дописываем оставшиеся в очереди записи
+        log_listener.stop()
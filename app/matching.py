@@ -0,0 +1,139 @@
+"""
+Сопоставление текста сообщений с правилами.
+Не зависит от Telethon: используется и обработчиками событий, и менеджером конфигурации.
+"""
+
+from typing import List, Dict, NamedTuple, Tuple
+
+
+class MatchedRule(NamedTuple):
+    """Сработавшее правило"""
+    rule_name: str
+    matched_keyword: str
+    target_chat_ids: List[int]
+
+
+class CompiledRule(NamedTuple):
+    """Правило, подготовленное для поиска"""
+    name: str
+    target_chat_ids: List[int]
+    case_sensitive: bool
+    keywords: Tuple[str, ...]  # Для нечувствительных к регистру - в нижнем регистре
+    min_len: int  # Текст короче не может содержать ни одного ключевого слова
+    original_keywords: Tuple[str, ...]  # Ключевые слова в исходном написании для отчёта
+
+
+def compile_rules(rules: List[Dict]) -> List[CompiledRule]:
+    """
+    Компилирует правила для быстрого поиска.
+    Ключевые слова нечувствительных к регистру правил приводятся
+    к нижнему регистру один раз, а не на каждое сообщение.
+    
+    Args:
+        rules: Список правил
+        
+    Returns:
+        Список скомпилированных правил
+    """
+    compiled = []
+    
+    for rule in rules:
+        keywords = rule.get('keywords', [])
+        if not keywords:
+            continue
+        
+        case_sensitive = rule.get('case_sensitive', False)
+        if case_sensitive:
+            prepared = tuple(keywords)
+            min_len = min(len(k) for k in prepared)
+        else:
+            prepared = tuple(k.lower() for k in keywords)
+            # lower() удлиняет строку только для 'İ' -> 'i' + U+0307
+            min_len = min(len(k) - k.count('\u0307') for k in prepared)
+        
+        compiled.append(CompiledRule(
+            name=rule.get('name', 'unnamed'),
+            target_chat_ids=rule.get('target_chat_ids', []),
+            case_sensitive=case_sensitive,
+            keywords=prepared,
+            min_len=min_len,
+            original_keywords=tuple(keywords)
+        ))
+    
+    return compiled
+
+
+def match_rules(text: str, compiled_rules: List[CompiledRule]) -> List[MatchedRule]:
+    """
+    Проверяет текст по скомпилированным правилам.
+    
+    Args:
+        text: Текст сообщения
+        compiled_rules: Результат compile_rules()
+        
+    Returns:
+        Список сработавших правил с информацией о совпадениях
+    """
+    if not text:
+        return []
+    
+    matched_rules = []
+    text_len = len(text)
+    text_lower = None
+    
+    for rule in compiled_rules:
+        # Короткие сообщения (эмодзи, одно слово) отсекаются без lower()
+        if text_len < rule.min_len:
+            continue
+        
+        # Текст в нижнем регистре вычисляется один раз на сообщение
+        if rule.case_sensitive:
+            check_text = text
+        else:
+            if text_lower is None:
+                text_lower = text.lower()
+            check_text = text_lower
+        
+        for keyword in rule.keywords:
+            if keyword in check_text:
+                if not rule.case_sensitive:
+                    keyword = rule.original_keywords[rule.keywords.index(keyword)]
+                matched_rules.append(MatchedRule(rule.name, keyword, rule.target_chat_ids))
+                break  # Одного совпадения достаточно для правила
+    
+    return matched_rules
+
+
+def check_message_against_rules(text: str, rules: List[Dict]) -> List[MatchedRule]:
+    """
+    Проверяет текст по всем правилам.
+    Для горячего пути используйте match_rules() с заранее скомпилированными правилами.
+    
+    Args:
+        text: Текст сообщения
+        rules: Список правил
+        
+    Returns:
+        Список сработавших правил с информацией о совпадениях
+    """
+    return match_rules(text, compile_rules(rules))
+
+
+def get_unique_target_chats(matched_rules: List[MatchedRule]) -> List[int]:
+    """
+    Собирает уникальные target чаты из всех сработавших правил.
+    Дедупликация по ID чата, порядок первого появления сохраняется.
+    
+    Args:
+        matched_rules: Список сработавших правил
+        
+    Returns:
+        Список уникальных chat_id
+    """
+    # Частый случай - одно правило: его цели уже без дублей (чистятся при загрузке)
+    if len(matched_rules) == 1:
+        return list(matched_rules[0].target_chat_ids)
+    
+    return list(dict.fromkeys(
+        chat_id for rule in matched_rules for chat_id in rule.target_chat_ids
+    ))
@@ -4,16 +4,19 @@
 """
 
 import json
+import os
 import time
 import asyncio
+import heapq
 import logging
-import shutil
+import struct
 from pathlib import Path
 from typing import Dict, Any, List, Tuple, Optional, Set
 
 from telethon.errors import (
     FloodWaitError, ChatIdInvalidError, ChannelPrivateError, 
-    UserBannedInChannelError, ChatWriteForbiddenError
+    UserBannedInChannelError, ChatWriteForbiddenError,
+    PeerIdInvalidError, UserIsBlockedError, ServerError
 )
 # Импортируем только стандартные исключения, если они не из Telethon
 # Telethon errors usually inherit from RPCError -> Exception
@@ -25,8 +28,27 @@ logger = logging.getLogger(__name__)
 # Максимальное количество попыток для временных ошибок
 MAX_RETRIES = 5
 
+# Сколько файлов очереди worker берёт за один проход
+QUEUE_BATCH_SIZE = 64
+
+# Страховочный период опроса пустой очереди (файлы могут вернуть вручную из queue_failed)
+IDLE_POLL_INTERVAL = 60
+
+# Сколько отправок одного сообщения выполняется одновременно
+SEND_CONCURRENCY = 5
+
+# Лимиты Telegram: не более 30 сообщений в секунду всего и 20 в минуту в одну группу
+OVERALL_RATE_LIMIT = (30, 1.0)
+CHAT_RATE_LIMIT = (20, 60.0)
+
+# Максимальная длина текстового сообщения Telegram (в UTF-16 code units)
+TELEGRAM_MESSAGE_LIMIT = 4096
+
+# Сколько резолвленных peer держать в кэше (самые старые вытесняются)
+ENTITY_CACHE_SIZE = 1024
+
 # Временные ошибки (будем повторять)
-TEMPORARY_ERRORS = (FloodWaitError, TimeoutError, ConnectionError)
+TEMPORARY_ERRORS = (FloodWaitError, ServerError, TimeoutError, ConnectionError)
 
 # Постоянные ошибки (пропускаем чат)
 PERMANENT_ERRORS = (
@@ -34,9 +56,61 @@ PERMANENT_ERRORS = (
     ChannelPrivateError, 
     UserBannedInChannelError,
     ChatWriteForbiddenError,
+    PeerIdInvalidError,
+    UserIsBlockedError,
+)
+
+# Ошибки записи в целевой чат: чат блокируется и больше не запрашивается
+# (ChatIdInvalid/ChannelPrivate/PeerIdInvalid в режиме forward могут относиться к исходному чату,
+# UserBannedInChannel - временное ограничение всего аккаунта, а не отказ конкретного чата)
+BLOCKING_ERRORS = (
+    ChatWriteForbiddenError,
+    UserIsBlockedError,
 )
 
 
+def utf16_len(text: str) -> int:
+    """Длина текста в единицах UTF-16 (так считает лимит Telegram)"""
+    return len(text.encode('utf-16-le')) // 2
+
+
+class RateLimiter:
+    """
+    Token bucket: не более max_rate операций за time_period секунд.
+    Позволяет не доводить до FloodWaitError, а заранее растягивать отправку.
+    """
+    
+    def __init__(self, max_rate: int, time_period: float):
+        self.max_rate = max_rate
+        self.time_period = time_period
+        self._tokens = float(max_rate)
+        self._updated: Optional[float] = None
+        self._lock = asyncio.Lock()
+    
+    async def acquire(self) -> None:
+        """Ждёт, пока появится свободный токен, и забирает его"""
+        async with self._lock:
+            loop = asyncio.get_running_loop()
+            while True:
+                now = loop.time()
+                if self._updated is not None:
+                    refill = (now - self._updated) * self.max_rate / self.time_period
+                    self._tokens = min(self.max_rate, self._tokens + refill)
+                self._updated = now
+                
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                
+                await asyncio.sleep((1 - self._tokens) * self.time_period / self.max_rate)
+    
+    async def __aenter__(self):
+        await self.acquire()
+    
+    async def __aexit__(self, exc_type, exc, tb):
+        return False
+
+
 class QueueManager:
     """Менеджер файловой очереди сообщений"""
     
@@ -55,6 +129,17 @@ class QueueManager:
         self.failed_dir = self.queue_dir.parent / 'queue_failed'
         self.failed_dir.mkdir(parents=True, exist_ok=True)
         
+        # chat_id -> InputPeer: get_input_entity ходит в SQLite-сессию на каждый вызов
+        self._entity_cache: Dict[int, Any] = {}
+        self._send_sem = asyncio.Semaphore(SEND_CONCURRENCY)
+        # Будит worker, когда в пустую очередь добавляется сообщение
+        self._wake = asyncio.Event()
+        self._last_timestamp = 0
+        
+        # Лимиты отправки: общий и по каждому целевому чату
+        self._overall_limiter = RateLimiter(*OVERALL_RATE_LIMIT)
+        self._chat_limiters: Dict[int, RateLimiter] = {}
+        
         logger.info(f"Queue manager инициализирован: {self.queue_dir}")
     
     def add_to_queue(self, message_data: Dict[str, Any]) -> None:
@@ -65,10 +150,13 @@ class QueueManager:
             message_data: Словарь с данными:
                 - message: message object from Telethon
                 - target_chats: List[int] - список ID целевых чатов
-                - matched_rules: List[Dict] - сработавшие правила
+                - matched_rules: List[MatchedRule] - сработавшие правила
                 - forward_mode: str - 'forward' или 'copy'
         """
-        timestamp = int(time.time() * 1000000)
+        # Микросекунды целочисленно (без float); строго возрастают,
+        # чтобы два сообщения в одну микросекунду не перезаписали один файл
+        timestamp = max(time.time_ns() // 1000, self._last_timestamp + 1)
+        self._last_timestamp = timestamp
         filename = self.queue_dir / f"{timestamp}.json"
         
         # Сохраняем message_id и from_chat_id для forward mode
@@ -79,28 +167,44 @@ class QueueManager:
             'message_text': message_data['message'].text or '',
             'target_chat_ids': message_data['target_chats'],
             'sent_chat_ids': [],  # Список ID чатов, куда успешно отправлено
-            'matched_rules': [r['rule_name'] for r in message_data['matched_rules']],
+            'matched_rules': [r.rule_name for r in message_data['matched_rules']],
             'forward_mode': message_data.get('forward_mode', 'copy'),
             'timestamp': timestamp,
             'retry_count': 0  # Счетчик попыток отправки
         }
         
         self._save_queue_item(filename, queue_item)
+        self._wake.set()
         
         logger.info(
-            f"Сообщение добавлено в очередь: правила={queue_item['matched_rules']}, "
-            f"чатов={len(queue_item['target_chat_ids'])}"
+            "Сообщение добавлено в очередь: правила=%s, чатов=%d",
+            queue_item['matched_rules'], len(queue_item['target_chat_ids'])
         )
     
-    def get_queue_items(self) -> List[Path]:
-        """Возвращает список файлов очереди отсортированные по времени."""
-        return sorted(self.queue_dir.glob('*.json'))
+    def get_queue_items(self, limit: Optional[int] = None) -> List[Path]:
+        """
+        Возвращает список файлов очереди отсортированные по времени.
+        Имена файлов - timestamp одинаковой длины, поэтому порядок имён совпадает с порядком времени.
+        
+        Args:
+            limit: Вернуть только limit самых старых файлов (None - все)
+        """
+        with os.scandir(self.queue_dir) as it:
+            names = [entry.name for entry in it if entry.name.endswith('.json') and entry.is_file()]
+        
+        if limit is not None and limit < len(names):
+            names = heapq.nsmallest(limit, names)
+        else:
+            names.sort()
+        
+        return [self.queue_dir / name for name in names]
     
     def remove_from_queue(self, filename: Path) -> None:
         """Удаляет файл из очереди после успешной отправки."""
         try:
             filename.unlink()
-            logger.info(f"Файл очереди удалён: {filename.name}")
+            self._sent_log_path(filename).unlink(missing_ok=True)
+            logger.info("Файл очереди удалён: %s", filename.name)
         except Exception as e:
             logger.error(f"Ошибка удаления файла очереди {filename}: {e}")
 
@@ -108,28 +212,94 @@ class QueueManager:
         """Перемещает файл в директорию failed."""
         try:
             dest = self.failed_dir / filename.name
-            shutil.move(str(filename), str(dest))
+            # queue/ и queue_failed/ лежат в одном каталоге - достаточно одного rename
+            filename.replace(dest)
+            self._sent_log_path(filename).unlink(missing_ok=True)
             logger.warning(f"Сообщение перемещено в failed (limit exceeded): {filename.name}")
         except Exception as e:
             logger.error(f"Ошибка перемещения в failed {filename}: {e}")
 
-    def _save_queue_item(self, filename: Path, data: Dict[str, Any]) -> None:
-        """Сохраняет обновленные данные элемента очереди."""
+    def _save_queue_item(self, filename: Path, data: Dict[str, Any]) -> bool:
+        """
+        Сохраняет обновленные данные элемента очереди.
+        
+        Returns:
+            True если файл записан
+        """
         try:
-            with open(filename, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
+            # Сериализуем целиком и пишем одним вызовом, а не кусками из json.dump.
+            # Файлы очереди читает только бот - компактный формат без отступов
+            payload = json.dumps(data, ensure_ascii=False, separators=(',', ':'))
+            # Атомарная запись: worker никогда не увидит наполовину записанный файл
+            tmp_file = filename.with_name(filename.name + '.tmp')
+            tmp_file.write_text(payload, encoding='utf-8')
+            os.replace(tmp_file, filename)
+            return True
         except Exception as e:
             logger.error(f"Ошибка сохранения файла очереди {filename}: {e}")
+            return False
+
+    async def _save_pass_results(self, filename: Path, data: Dict[str, Any]) -> None:
+        """
+        Записывает результаты прохода в JSON элемента очереди.
+        Журнал доставок удаляется только после успешной записи: иначе он остаётся
+        единственной записью о доставленных чатах и защищает от повторной отправки.
+        """
+        await asyncio.to_thread(self._save_and_drop_sent_log, filename, data)
+
+    def _save_and_drop_sent_log(self, filename: Path, data: Dict[str, Any]) -> None:
+        """Синхронная часть _save_pass_results (выполняется в пуле потоков)"""
+        if self._save_queue_item(filename, data):
+            self._sent_log_path(filename).unlink(missing_ok=True)
+
+    @staticmethod
+    def _sent_log_path(filename: Path) -> Path:
+        """
+        Журнал доставок элемента очереди: по 8 байт (chat_id) на каждый обработанный чат.
+        Дописывается сразу после отправки, а JSON переписывается один раз за проход.
+        """
+        return filename.with_suffix('.sent')
+
+    def _read_sent_log(self, filename: Path) -> Set[int]:
+        """Читает журнал доставок (остаётся, если процесс прервался посреди прохода)"""
+        try:
+            raw = self._sent_log_path(filename).read_bytes()
+        except FileNotFoundError:
+            return set()
+        
+        # Недописанная запись в конце журнала отбрасывается
+        usable = len(raw) - len(raw) % 8
+        return {chat_id for (chat_id,) in struct.iter_unpack('<q', raw[:usable])}
 
     def _load_queue_item(self, filename: Path) -> Optional[Dict[str, Any]]:
         """Загружает данные из файла очереди."""
         try:
-            with open(filename, 'r', encoding='utf-8') as f:
-                return json.load(f)
+            return json.loads(filename.read_bytes())
         except Exception as e:
             logger.error(f"Ошибка чтения файла очереди {filename}: {e}")
             return None
     
+    async def _get_input_peer(self, client, chat_id: int):
+        """Возвращает InputPeer чата, резолвя его через клиент только один раз"""
+        peer = self._entity_cache.get(chat_id)
+        if peer is None:
+            peer = await client.get_input_entity(chat_id)
+            if len(self._entity_cache) >= ENTITY_CACHE_SIZE:
+                # dict сохраняет порядок вставки - удаляем самый старый
+                del self._entity_cache[next(iter(self._entity_cache))]
+            self._entity_cache[chat_id] = peer
+        return peer
+
+    async def _wait_send_slot(self, chat_id: int) -> None:
+        """Ждёт, пока отправка в чат уложится в лимиты Telegram"""
+        limiter = self._chat_limiters.get(chat_id)
+        if limiter is None:
+            limiter = self._chat_limiters[chat_id] = RateLimiter(*CHAT_RATE_LIMIT)
+        
+        # Сначала лимит чата: иначе общий токен простаивал бы в ожидании
+        await limiter.acquire()
+        await self._overall_limiter.acquire()
+
     async def send_message_safe(
         self,
         client,
@@ -146,55 +316,99 @@ class QueueManager:
             error_type: 'none' | 'permanent' | 'unknown'
             (TEMPORARY_ERRORS are raised to be handled by caller)
         """
+        # Чат, в который писать запрещено, пропускаем без обращения к API
+        if self.config_mgr.is_blocked_target(chat_id):
+            logger.info("Skipping blocked chat %s", chat_id)
+            return False, 'permanent'
+        
         try:
             # Резолвим целевую сущность (чат)
             try:
-                target_peer = await client.get_input_entity(chat_id)
+                target_peer = await self._get_input_peer(client, chat_id)
             except ValueError:
                 # Если не удалось зарезолвить entitty -> вероятно нет доступа или чат не найден
                 # Считаем это постоянной ошибкой для данного chat_id
-                logger.error(f"Could not resolve entity for chat_id {chat_id}")
+                logger.error("Could not resolve entity for chat_id %s", chat_id)
                 return False, 'permanent'
 
             if forward_mode == 'forward':
                 try:
-                    from_peer = await client.get_input_entity(message_data['from_chat_id'])
+                    from_peer = await self._get_input_peer(client, message_data['from_chat_id'])
                 except ValueError:
-                     logger.error(f"Could not resolve source chat {message_data['from_chat_id']}")
+                     logger.error("Could not resolve source chat %s", message_data['from_chat_id'])
                      return False, 'permanent'
 
+                await self._wait_send_slot(chat_id)
                 await client.forward_messages(
                     target_peer,
                     messages=message_data['message_id'],
                     from_peer=from_peer
                 )
             else:
-                await client.send_message(target_peer, message_data['message_text'])
+                text = message_data['message_text']
+                if rule_names:
+                    # В режиме copy уведомление о правиле добавляется в то же сообщение,
+                    # если помещается в лимит длины: один запрос вместо двух
+                    combined = f"{text}\n\nℹ️ Сработало правило: {', '.join(rule_names)}"
+                    if utf16_len(combined) <= TELEGRAM_MESSAGE_LIMIT:
+                        text = combined
+                        rule_names = None
+                
+                await self._wait_send_slot(chat_id)
+                await client.send_message(target_peer, text)
             
             # Отправка уведомления о правиле (вторым сообщением) - опционально, ошибки тут не блокируют основную
             if rule_names:
                 rules_str = ', '.join(rule_names)
                 try:
+                    await self._wait_send_slot(chat_id)
                     await client.send_message(target_peer, f"ℹ️ Сработало правило: {rules_str}")
                 except Exception as e:
-                    logger.warning(f"Не удалось отправить уведомление о правиле в {chat_id}: {e}")
+                    logger.warning("Не удалось отправить уведомление о правиле в %s: %s", chat_id, e)
             
-            logger.info(f"Сообщение отправлено в {chat_id}")
+            logger.info("Сообщение отправлено в %s", chat_id)
             return True, 'none'
             
         except TEMPORARY_ERRORS as e:
             wait = getattr(e, 'seconds', 0)
-            logger.warning(f"Temporary error sending to {chat_id} (wait={wait}): {e}")
+            logger.warning("Temporary error sending to %s (wait=%s): %s", chat_id, wait, e)
             raise e  # Re-raise to handle retry/sleep in loop
             
         except PERMANENT_ERRORS as e:
-            logger.error(f"Permanent error sending to {chat_id}: {type(e).__name__}: {e}")
+            logger.error("Permanent error sending to %s: %s: %s", chat_id, type(e).__name__, e)
+            # Доступ к чату мог измениться - в следующий раз резолвим заново
+            self._entity_cache.pop(chat_id, None)
+            if isinstance(e, BLOCKING_ERRORS):
+                self.config_mgr.block_target(chat_id)
             return False, 'permanent'
             
         except Exception as e:
-            logger.error(f"Unknown error sending to {chat_id}: {type(e).__name__}: {e}")
+            logger.error("Unknown error sending to %s: %s: %s", chat_id, type(e).__name__, e)
             return False, 'unknown'
     
+    async def _send_to_target(
+        self,
+        client,
+        target_id: int,
+        data: Dict[str, Any],
+        sent_log_fd: int
+    ) -> Tuple[bool, str]:
+        """Отправляет элемент очереди в один чат с ограничением параллельности"""
+        async with self._send_sem:
+            success, error_type = await self.send_message_safe(
+                client,
+                target_id,
+                data,
+                data.get('forward_mode', 'copy'),
+                rule_names=data.get('matched_rules')
+            )
+        
+        # Обработанный чат сразу фиксируется в журнале: после сбоя не отправим повторно
+        if success or error_type == 'permanent':
+            await asyncio.to_thread(os.write, sent_log_fd, struct.pack('<q', target_id))
+        
+        return success, error_type
+    
     async def process_queue(self, client) -> None:
         """
         Фоновый worker для обработки очереди.
@@ -203,81 +417,91 @@ class QueueManager:
         
         while True:
             try:
-                queue_items = self.get_queue_items()
+                queue_items = await asyncio.to_thread(self.get_queue_items, QUEUE_BATCH_SIZE)
                 
                 if not queue_items:
-                    # Очередь пуста, короткий сон
-                    await asyncio.sleep(1)
+                    # Очередь пуста - ждём сигнала от add_to_queue
+                    self._wake.clear()
+                    try:
+                        await asyncio.wait_for(self._wake.wait(), IDLE_POLL_INTERVAL)
+                    except asyncio.TimeoutError:
+                        pass
                     continue
                 
                 for item_file in queue_items:
-                    data = self._load_queue_item(item_file)
+                    # Файловые операции worker'а - в пуле потоков, чтобы не блокировать event loop
+                    data = await asyncio.to_thread(self._load_queue_item, item_file)
                     if data is None:
                         # Файл битый
-                        self.remove_from_queue(item_file)
+                        await asyncio.to_thread(self.remove_from_queue, item_file)
                         continue
                     
-                    # Фильтруем получателей
-                    sent_ids = set(data.get('sent_chat_ids', []))
+                    # Фильтруем получателей (с учётом журнала прерванного прохода)
+                    sent_log = await asyncio.to_thread(self._read_sent_log, item_file)
+                    sent_ids = set(data.get('sent_chat_ids', [])) | sent_log
                     all_targets = data.get('target_chat_ids', [])
                     
                     # Target chat ids filter: only those not in sent_ids
                     pending_ids = [tid for tid in all_targets if tid not in sent_ids]
                     
                     if not pending_ids:
-                        self.remove_from_queue(item_file)
+                        await asyncio.to_thread(self.remove_from_queue, item_file)
                         continue
                     
                     flood_wait_seconds = 0
                     should_retry = False
                     
-                    for target_id in pending_ids:
-                        try:
-                            success, error_type = await self.send_message_safe(
-                                client,
-                                target_id,
-                                data,
-                                data.get('forward_mode', 'copy'),
-                                rule_names=data.get('matched_rules')
-                            )
-                            
+                    # Отправляем во все целевые чаты параллельно (не более SEND_CONCURRENCY одновременно)
+                    sent_log_fd = await asyncio.to_thread(
+                        os.open,
+                        self._sent_log_path(item_file),
+                        os.O_WRONLY | os.O_CREAT | os.O_APPEND
+                    )
+                    try:
+                        results = await asyncio.gather(
+                            *(self._send_to_target(client, target_id, data, sent_log_fd)
+                              for target_id in pending_ids),
+                            return_exceptions=True
+                        )
+                    finally:
+                        await asyncio.to_thread(os.close, sent_log_fd)
+                    
+                    for target_id, result in zip(pending_ids, results):
+                        if isinstance(result, FloodWaitError):
+                            seconds = getattr(result, 'seconds', 60)
+                            flood_wait_seconds = max(flood_wait_seconds, seconds)
+                            logger.warning("FloodWait hit: %ss", seconds)
+                            should_retry = True
+                        elif isinstance(result, BaseException):
+                            # Другие временные ошибки (ConnectionError etc)
+                            logger.warning("Temporary error hit: %s", result)
+                            should_retry = True
+                        else:
+                            success, error_type = result
                             if success:
                                 sent_ids.add(target_id)
-                                data['sent_chat_ids'] = list(sent_ids)
-                                self._save_queue_item(item_file, data)
                             elif error_type == 'permanent':
                                 # При постоянной ошибке тоже считаем "обработанным", чтобы не зацикливаться
-                                logger.warning(f"Skipping chat {target_id} due to permanent error")
+                                logger.warning("Skipping chat %s due to permanent error", target_id)
                                 sent_ids.add(target_id)
-                                data['sent_chat_ids'] = list(sent_ids)
-                                self._save_queue_item(item_file, data)
                             elif error_type == 'unknown':
                                 should_retry = True
-                                break # Stop and retry later
-                                
-                        except FloodWaitError as e:
-                            flood_wait_seconds = getattr(e, 'seconds', 60)
-                            logger.warn(f"FloodWait hit: {flood_wait_seconds}s")
-                            should_retry = True
-                            break
-                        except Exception as e:
-                            # Другие временные ошибки (ConnectionError etc)
-                            logger.warn(f"Temporary error hit: {e}")
-                            should_retry = True
-                            break
+                    
+                    # Результаты всех отправок записываются одним сохранением
+                    data['sent_chat_ids'] = list(sent_ids)
                     
                     if should_retry:
-                        # Увеличиваем счетчик попыток только если прервали цикл
+                        # Увеличиваем счетчик попыток только если были временные ошибки
                         data['retry_count'] = data.get('retry_count', 0) + 1
-                        self._save_queue_item(item_file, data)
+                        await self._save_pass_results(item_file, data)
                         
                         if data['retry_count'] >= MAX_RETRIES:
-                            logger.error(f"Max retries exceeded for {item_file.name}")
-                            self.move_to_failed(item_file)
+                            logger.error("Max retries exceeded for %s", item_file.name)
+                            await asyncio.to_thread(self.move_to_failed, item_file)
                         else:
                             if flood_wait_seconds > 0:
                                 wait_time = flood_wait_seconds + 2
-                                logger.info(f"Sleeping for FloodWait: {wait_time}s")
+                                logger.info("Sleeping for FloodWait: %ss", wait_time)
                                 await asyncio.sleep(wait_time)
                             else:
                                 await asyncio.sleep(5) # Default retry delay
@@ -290,8 +514,10 @@ class QueueManager:
                     # Если прошли цикл без should_retry -> значит все pending_ids обработаны (успешно или перманентно)
                     # Проверяем на всякий случай
                     if len(set(data['sent_chat_ids'])) >= len(all_targets):
-                         self.remove_from_queue(item_file)
-                         logger.info(f"Сообщение {item_file.name} полностью обработано")
+                         await asyncio.to_thread(self.remove_from_queue, item_file)
+                         logger.info("Сообщение %s полностью обработано", item_file.name)
+                    else:
+                        await self._save_pass_results(item_file, data)
                 
                 # Небольшая пауза между проходами по списку файлов (если список был), 
                 # но если очередь большая, лучше молотить подряд. 
@@ -299,5 +525,5 @@ class QueueManager:
                 await asyncio.sleep(0.1)
 
             except Exception as e:
-                logger.error(f"Critical error in queue_worker: {e}", exc_info=True)
+                logger.error("Critical error in queue_worker: %s", e, exc_info=True)
                 await asyncio.sleep(5)
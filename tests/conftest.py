@@ -3,6 +3,8 @@ import pytest
 import os
 import json
 from unittest.mock import AsyncMock, MagicMock
+from telethon import TelegramClient
+
 from app.config_manager import ConfigManager
 from app.queue_manager import QueueManager
 
@@ -23,9 +25,8 @@ def temp_env(tmp_path):
 @pytest.fixture
 def mock_client():
     """Mock Telethon клиента"""
-    client = AsyncMock()
-    client.send_message = AsyncMock()
-    client.forward_messages = AsyncMock()
+    client = AsyncMock(spec=TelegramClient)
+    client.get_input_entity.return_value = MagicMock()
     return client
 
 @pytest.fixture
@@ -34,8 +35,10 @@ def config_mgr(temp_env):
     return ConfigManager(str(temp_env['config']), str(temp_env['rules']))
 
 @pytest.fixture
-def queue_mgr(config_mgr, temp_env):
-    """Фикстура QueueManager с временной директорией"""
+def queue_mgr(temp_env):
+    """Фикстура QueueManager с временной директорией и mock конфигурацией"""
+    config_mgr = MagicMock()
+    config_mgr.is_blocked_target.return_value = False
     return QueueManager(config_mgr, str(temp_env['queue']))
 
 @pytest.fixture
@@ -44,5 +47,20 @@ def sample_message():
     message = MagicMock()
     message.id = 123
     message.chat_id = -100111
-    message.text = "Test message text"
+    message.text = "Test message"
     return message
+
+@pytest.fixture
+def msg_data(sample_message):
+    """Элемент очереди в том виде, в котором его сохраняет add_to_queue"""
+    return {
+        'message_id': sample_message.id,
+        'from_chat_id': sample_message.chat_id,
+        'message_text': sample_message.text,
+        'target_chat_ids': [-1001],
+        'sent_chat_ids': [],
+        'matched_rules': [],
+        'forward_mode': 'copy',
+        'timestamp': 0,
+        'retry_count': 0
+    }
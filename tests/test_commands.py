@@ -19,3 +19,168 @@ async def test_cmd_test_message_imports(config_mgr):
     
     # Проверяем, что ответ был отправлен (значит функция отработала без ModuleNotFoundError)
     assert event.reply.called
+
+
+class _FakeClient:
+    """Минимальный клиент: запоминает зарегистрированные обработчики"""
+    def __init__(self):
+        self.handlers = []
+
+    def on(self, event_builder):
+        def decorator(func):
+            self.handlers.append(func)
+            return func
+        return decorator
+
+
+def _make_event(text):
+    event = MagicMock()
+    event.text = text
+    event.reply = AsyncMock()
+    return event
+
+
+@pytest.mark.asyncio
+async def test_router_dispatch(config_mgr, monkeypatch):
+    """Роутер вызывает обработчик из таблицы COMMANDS с аргументами"""
+    from app import commands
+
+    calls = []
+
+    async def fake_handler(event, mgr, args):
+        calls.append(args)
+
+    monkeypatch.setitem(commands.COMMANDS, '/test', fake_handler)
+
+    client = _FakeClient()
+    commands.setup_commands(client, config_mgr)
+    handle = client.handlers[0]
+
+    await handle(_make_event("/TEST hello world"))
+    assert calls == ['hello world']
+
+    # Аргументы после перевода строки или таба
+    await handle(_make_event("/test\nBitcoin news"))
+    await handle(_make_event("/test\tfoo"))
+    assert calls == ['hello world', 'Bitcoin news', 'foo']
+
+    # Команда распознаётся целиком до пробельного символа
+    for text in ("/test:foo", "/rules,"):
+        event = _make_event(text)
+        await handle(event)
+        assert f"Неизвестная команда: {text}" in event.reply.call_args[0][0]
+    assert len(calls) == 3
+
+    event = _make_event("/unknown")
+    await handle(event)
+    assert "Неизвестная команда: /unknown" in event.reply.call_args[0][0]
+
+
+@pytest.mark.asyncio
+async def test_add_chat_uses_forward_entity(config_mgr):
+    """/add_chat берёт сущность из пересланного сообщения без get_entity"""
+    from telethon.tl.types import Channel, ChatPhotoEmpty, PeerChannel
+    from app.commands import cmd_add_chat
+
+    channel = Channel(id=1234567890, title="News", photo=ChatPhotoEmpty(), date=None)
+
+    reply_msg = MagicMock()
+    reply_msg.fwd_from.from_id = PeerChannel(channel_id=1234567890)
+    reply_msg.forward.chat = channel
+
+    event = _make_event("/add_chat")
+    event.message.is_reply = True
+    event.get_reply_message = AsyncMock(return_value=reply_msg)
+    event.client.get_entity = AsyncMock()
+
+    await cmd_add_chat(event, config_mgr, '')
+
+    event.client.get_entity.assert_not_called()
+    assert -1001234567890 in config_mgr.get_monitored_chat_ids()
+    assert "News" in event.reply.call_args[0][0]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_reload_loads_once(config_mgr, monkeypatch):
+    """Параллельные /reload выполняют одну загрузку конфигурации"""
+    import asyncio
+    from app.commands import cmd_reload
+
+    config_mgr.load()
+    calls = []
+
+    async def slow_reload():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+
+    monkeypatch.setattr(config_mgr, 'reload', slow_reload)
+
+    events_ = [_make_event("/reload") for _ in range(3)]
+    await asyncio.gather(*(cmd_reload(e, config_mgr, '') for e in events_))
+
+    assert calls == [1]
+    replies = [e.reply.call_args[0][0] for e in events_]
+    assert sum("уже перезагружена" in r for r in replies) == 2
+
+
+def test_pack_chunks_respects_limit():
+    """Длинный ответ делится на сообщения в пределах лимита, порядок сохраняется"""
+    from app.commands import _pack_chunks
+
+    parts = [f"{i}️⃣ правило\n" for i in range(100)]
+    chunks = _pack_chunks(parts, limit=200)
+
+    assert len(chunks) > 1
+    assert all(len(c.encode('utf-16-le')) // 2 <= 200 for c in chunks)
+    assert ''.join(chunks) == ''.join(parts)
+
+    # Часть длиннее лимита режется
+    long_chunks = _pack_chunks(["x" * 450], limit=200)
+    assert ''.join(long_chunks) == "x" * 450
+    assert all(len(c) <= 200 for c in long_chunks)
+
+
+@pytest.mark.asyncio
+async def test_list_rules_rendered_cache(config_mgr):
+    """/rules переформатирует правила только после их изменения"""
+    from app.commands import cmd_list_rules
+
+    config_mgr.load()
+    config_mgr.add_rule('r1', ['a'], [-100])
+
+    event = _make_event("/rules")
+    await cmd_list_rules(event, config_mgr)
+    assert "1️⃣ **r1**" in event.reply.call_args[0][0]
+
+    config_mgr.add_rule('r2', ['b'], [-200])
+    await cmd_list_rules(event, config_mgr)
+    reply = event.reply.call_args[0][0]
+    assert "Активные правила (2)" in reply
+    assert "2️⃣ **r2**" in reply
+    assert "Заблокированные" not in reply
+
+    config_mgr.block_target(-300)
+    await cmd_list_rules(event, config_mgr)
+    assert "🚫 Заблокированные целевые чаты (1): -300" in event.reply.call_args[0][0]
+
+
+@pytest.mark.asyncio
+async def test_reply_chunks_resolves_peer_once(monkeypatch):
+    """Многосоставной ответ резолвит чат один раз и сохраняет порядок"""
+    from app import commands
+
+    pack = commands._pack_chunks
+    monkeypatch.setattr(commands, '_pack_chunks', lambda parts: pack(parts, limit=10))
+
+    event = _make_event("/rules")
+    event.id = 42
+    event.get_input_chat = AsyncMock(return_value='peer')
+    event.client.send_message = AsyncMock()
+
+    await commands._reply_chunks(event, ["aaaaaa", "bbbbbb", "cccccc"])
+
+    event.get_input_chat.assert_awaited_once()
+    sent = [c.args[1] for c in event.client.send_message.call_args_list]
+    assert sent == ["aaaaaa", "bbbbbb", "cccccc"]
+    assert all(c.kwargs['reply_to'] == 42 for c in event.client.send_message.call_args_list)
+    event.reply.assert_not_called()
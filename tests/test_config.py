@@ -62,7 +62,255 @@ def test_add_monitored_chat(config_mgr):
     added = config_mgr.add_monitored_chat(123, "New Chat")
     assert added is True
     assert 123 in config_mgr.get_monitored_chat_ids()
+    assert config_mgr.is_monitored_chat(123)
+    assert not config_mgr.is_monitored_chat(456)
+    assert config_mgr.monitored_ids == frozenset({123})
     
     # Добавление дубликата
     added = config_mgr.add_monitored_chat(123, "New Chat")
     assert added is False
+
+def test_reload_skips_unchanged_config(config_mgr, temp_env, monkeypatch):
+    """Повторная загрузка не перечитывает неизменённый config.json"""
+    config_mgr.load()
+
+    calls = []
+    original = config_mgr._load_config_json
+    monkeypatch.setattr(config_mgr, '_load_config_json', lambda: calls.append(1) or original())
+
+    config_mgr.load()
+    assert calls == []
+
+    # Внешнее изменение файла должно быть подхвачено
+    data = json.loads(temp_env['config'].read_text(encoding='utf-8'))
+    data['forward_mode'] = 'forward'
+    temp_env['config'].write_text(json.dumps(data), encoding='utf-8')
+
+    config_mgr.load()
+    assert calls == [1]
+    assert config_mgr.get_forward_mode() == 'forward'
+
+def test_parse_rule_line_invalid_returns_none(config_mgr):
+    """Ошибки формата правила возвращают None без исключения"""
+    assert config_mgr._parse_rule_line("a -> b: c") is None
+    assert config_mgr._parse_rule_line("name: -> -100") is None
+    assert config_mgr._parse_rule_line("name: kw -> abc") is None
+
+def test_save_skips_unchanged_and_is_atomic(config_mgr, temp_env):
+    """Неизменённая конфигурация не перезаписывается, временный файл не остаётся"""
+    config_mgr.load()
+    key = config_mgr._config_file_key()
+
+    assert config_mgr._save_config_json() is False
+    assert config_mgr._config_file_key() == key
+
+    config_mgr.config['forward_mode'] = 'forward'
+    assert config_mgr._save_config_json() is True
+    assert json.loads(temp_env['config'].read_text(encoding='utf-8'))['forward_mode'] == 'forward'
+    assert not os.path.exists(f"{temp_env['config']}.tmp")
+
+    # Удалённый извне файл записывается заново
+    os.remove(temp_env['config'])
+    assert config_mgr._save_config_json() is True
+    assert os.path.exists(temp_env['config'])
+
+@pytest.mark.asyncio
+async def test_burst_of_changes_saved_once(config_mgr, temp_env, monkeypatch):
+    """Серия изменений в event loop записывается на диск один раз"""
+    config_mgr.load()
+
+    writes = []
+    original = config_mgr._save_config_json
+    monkeypatch.setattr(config_mgr, '_save_config_json', lambda: writes.append(1) or original())
+
+    for chat_id in (1, 2, 3):
+        assert config_mgr.add_monitored_chat(chat_id, f"Chat {chat_id}")
+
+    # Изменения видны сразу, запись отложена
+    assert config_mgr.is_monitored_chat(3)
+    assert writes == []
+
+    config_mgr.flush()
+    assert writes == [1]
+    saved = json.loads(temp_env['config'].read_text(encoding='utf-8'))
+    assert [c['id'] for c in saved['monitored_chats']] == [1, 2, 3]
+
+    # Повторный flush без изменений ничего не пишет
+    config_mgr.flush()
+    assert writes == [1]
+
+def test_parse_rule_line_quoted_chat_names(config_mgr):
+    """Запятые внутри названий чатов не разделяют целевые чаты"""
+    rule = config_mgr._parse_rule_line('r: kw -> -100 "News, daily", -200 "Other" [case:on]')
+    assert rule['target_chat_ids'] == [-100, -200]
+    assert rule['case_sensitive'] is True
+
+def test_add_and_remove_rule_by_name(config_mgr):
+    """Тест обновления и удаления правил через индекс имён"""
+    config_mgr.load()
+    config_mgr.add_rule('a', ['x'], [-100])
+    config_mgr.add_rule('b', ['y'], [-100])
+    config_mgr.add_rule('a', ['z'], [-100])
+    
+    rules = config_mgr.get_rules()
+    assert [r['name'] for r in rules] == ['a', 'b']
+    assert rules[0]['keywords'] == ['z']
+    
+    assert config_mgr.remove_rule('a') is True
+    assert config_mgr.remove_rule('a') is False
+    assert [r['name'] for r in config_mgr.get_rules()] == ['b']
+
+def test_lazy_load_without_rewrite(config_mgr, temp_env):
+    """Конфигурация загружается при первом обращении, неизменённый файл не перезаписывается"""
+    data = {
+        'forward_mode': 'forward',
+        'auto_add_chats': True,
+        'monitored_chats': [{'id': 123, 'name': 'Test'}],
+        'rules': []
+    }
+    raw = json.dumps(data)
+    temp_env['config'].write_text(raw, encoding='utf-8')
+    
+    assert config_mgr.get_forward_mode() == 'forward'
+    assert config_mgr.is_monitored_chat(123)
+    assert temp_env['config'].read_text(encoding='utf-8') == raw
+
+def test_rule_duplicates_removed(config_mgr):
+    """Повторяющиеся ключевые слова и целевые чаты убираются с сохранением порядка"""
+    rule = config_mgr._parse_rule_line('r: covid, flu, covid -> -100 "A", -200 "B", -100 "A"')
+    assert rule['keywords'] == ['covid', 'flu']
+    assert rule['target_chat_ids'] == [-100, -200]
+    
+    config_mgr.load()
+    config_mgr.add_rule('r2', ['x', 'x', 'y'], [-300, -300])
+    added = config_mgr.get_rules()[-1]
+    assert added['keywords'] == ['x', 'y']
+    assert added['target_chat_ids'] == [-300]
+
+def test_add_monitored_chat_rejects_target(config_mgr):
+    """Target чат правила не добавляется в monitored_chats"""
+    config_mgr.load()
+    config_mgr.add_rule('r', ['x'], [-100500])
+    assert config_mgr.add_monitored_chat(-100500, "Target") is False
+    assert not config_mgr.is_monitored_chat(-100500)
+    
+    # После удаления правила чат снова можно мониторить
+    config_mgr.remove_rule('r')
+    assert config_mgr.add_monitored_chat(-100500, "Target") is True
+
+def test_validate_and_clean_monitored(config_mgr):
+    """Коррекция ID, перепаковка старого формата и удаление target чатов из monitored_chats"""
+    config_mgr.config = {
+        'rules': [{'name': 'r', 'keywords': ['x'], 'target_chat_ids': [-1234567890]}],
+        'monitored_chats': [-1234567890, 555, {'id': -9876543210, 'name': 'Old'}]
+    }
+    assert config_mgr._validate_and_clean() is True
+    assert config_mgr.config['rules'][0]['target_chat_ids'] == [-1001234567890]
+    assert config_mgr.config['monitored_chats'] == [
+        {'id': 555, 'name': 'Unknown'},
+        {'id': -1009876543210, 'name': 'Old'},
+    ]
+    
+    # Повторная валидация ничего не меняет
+    assert config_mgr._validate_and_clean() is False
+
+def test_blocked_targets(config_mgr, temp_env):
+    """Блокировка целевых чатов сохраняется в config.json и снимается целиком"""
+    config_mgr.load()
+    assert config_mgr.block_target(-100500) is True
+    assert config_mgr.block_target(-100500) is False
+    assert config_mgr.is_blocked_target(-100500)
+    
+    saved = json.loads(temp_env['config'].read_text(encoding='utf-8'))
+    assert saved['blocked_target_ids'] == [-100500]
+    
+    assert config_mgr.clear_blocked_targets() == 1
+    assert not config_mgr.is_blocked_target(-100500)
+    assert config_mgr.clear_blocked_targets() == 0
+    
+    # Повторное указание чата в правиле снимает его блокировку
+    config_mgr.block_target(-1001234567890)
+    config_mgr.block_target(-200)
+    config_mgr.add_rule('r', ['x'], [-1234567890])  # ID корректируется до -1001234567890
+    assert not config_mgr.is_blocked_target(-1001234567890)
+    assert config_mgr.get_blocked_target_ids() == [-200]
+    saved = json.loads(temp_env['config'].read_text(encoding='utf-8'))
+    assert saved['blocked_target_ids'] == [-200]
+
+@pytest.mark.asyncio
+async def test_failed_save_keeps_changes(config_mgr, temp_env, monkeypatch):
+    """Ошибка записи не теряет изменения: правило - сразу ошибка, отложенное сохранение - повтор"""
+    import errno
+    config_mgr.load()
+    
+    def no_space(*args):
+        raise OSError(errno.ENOSPC, "No space left on device")
+    
+    monkeypatch.setattr(os, 'replace', no_space)
+    with pytest.raises(OSError):
+        config_mgr.add_rule('r', ['x'], [-100])
+    assert config_mgr._dirty is True
+    
+    # Отложенное сохранение логирует ошибку и планирует повтор
+    config_mgr.add_monitored_chat(1, "Chat")
+    config_mgr._deferred_flush()
+    assert config_mgr._dirty is True
+    assert config_mgr._save_handle is not None
+    
+    monkeypatch.undo()
+    config_mgr.flush()
+    assert config_mgr._dirty is False
+    saved = json.loads(temp_env['config'].read_text(encoding='utf-8'))
+    assert [r['name'] for r in saved['rules']] == ['r']
+    assert [c['id'] for c in saved['monitored_chats']] == [1]
+
+@pytest.mark.asyncio
+async def test_reload_keeps_changes_made_during_read(config_mgr, temp_env, monkeypatch):
+    """Изменения, сделанные пока reload() читает файл, не теряются"""
+    import asyncio
+    import threading
+    config_mgr.load()
+    
+    # Внешняя правка файла
+    data = json.loads(temp_env['config'].read_text(encoding='utf-8'))
+    data['forward_mode'] = 'forward'
+    temp_env['config'].write_text(json.dumps(data), encoding='utf-8')
+    
+    reading = threading.Event()
+    proceed = threading.Event()
+    original = config_mgr._load_config_json
+    
+    def slow_read():
+        reading.set()
+        proceed.wait(5)
+        return original()
+    
+    monkeypatch.setattr(config_mgr, '_load_config_json', slow_read)
+    
+    reload_task = asyncio.create_task(config_mgr.reload())
+    await asyncio.to_thread(reading.wait, 5)
+    assert config_mgr.add_monitored_chat(777, "During reload") is True
+    proceed.set()
+    await reload_task
+    
+    assert config_mgr.get_forward_mode() == 'forward'
+    assert config_mgr.is_monitored_chat(777)
+    config_mgr.flush()
+    saved = json.loads(temp_env['config'].read_text(encoding='utf-8'))
+    assert saved['forward_mode'] == 'forward'
+    assert [c['id'] for c in saved['monitored_chats']] == [777]
+
+def test_save_after_external_edit(config_mgr, temp_env):
+    """Изменение после загрузки отредактированного вручную файла записывается на диск"""
+    config_mgr.load()
+    config_mgr.add_rule('a', ['x'], [-100])
+    
+    data = json.loads(temp_env['config'].read_text(encoding='utf-8'))
+    data['rules'].append({'name': 'b', 'keywords': ['y'], 'target_chat_ids': [-200], 'case_sensitive': False})
+    temp_env['config'].write_text(json.dumps(data), encoding='utf-8')
+    
+    config_mgr.load()
+    assert config_mgr.remove_rule('b') is True
+    
+    saved = json.loads(temp_env['config'].read_text(encoding='utf-8'))
+    assert [r['name'] for r in saved['rules']] == ['a']
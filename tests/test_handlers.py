@@ -1,6 +1,6 @@
 
 import pytest
-from app.handlers import check_message_against_rules, get_unique_target_chats
+from app.handlers import MatchedRule, check_message_against_rules, get_unique_target_chats
 
 def test_check_message_simple_match():
     """Тест простого совпадения"""
@@ -16,8 +16,8 @@ def test_check_message_simple_match():
     # Совпадение
     matched = check_message_against_rules("This is a test message", rules)
     assert len(matched) == 1
-    assert matched[0]['rule_name'] == 'r1'
-    assert matched[0]['matched_keyword'] == 'test'
+    assert matched[0].rule_name == 'r1'
+    assert matched[0].matched_keyword == 'test'
     
     # Нет совпадения
     matched = check_message_against_rules("Another message", rules)
@@ -45,14 +45,77 @@ def test_check_message_case_sensitive():
 def test_get_unique_target_chats():
     """Тест дедупликации чатов"""
     matched_rules = [
-        {
-            'target_chat_ids': [-100, -200]
-        },
-        {
-            'target_chat_ids': [-200, -300]
-        }
+        MatchedRule('r1', 'a', [-100, -200]),
+        MatchedRule('r2', 'b', [-200, -300])
     ]
     
     unique = get_unique_target_chats(matched_rules)
     assert len(unique) == 3
     assert sorted(unique) == [-300, -200, -100]
+    assert unique == [-100, -200, -300]  # Порядок первого появления
+    
+    # Одно правило - возвращается копия его целей
+    single = get_unique_target_chats(matched_rules[:1])
+    assert single == [-100, -200]
+    assert single is not matched_rules[0].target_chat_ids
+
+def test_compiled_rules_rebuilt_on_change(tmp_path):
+    """Скомпилированные правила пересобираются при изменении правил"""
+    from app.config_manager import ConfigManager
+    from app.handlers import match_rules
+
+    cm = ConfigManager(str(tmp_path / "config.json"), str(tmp_path / "rules.txt"))
+    cm.load()
+    assert match_rules("Bitcoin растёт", cm.get_compiled_rules()) == []
+
+    cm.add_rule('crypto', ['bitcoin', 'BTC'], [-100], case_sensitive=False)
+    matched = match_rules("Bitcoin растёт", cm.get_compiled_rules())
+    assert [r.rule_name for r in matched] == ['crypto']
+    assert matched[0].matched_keyword == 'bitcoin'
+
+    cm.remove_rule('crypto')
+    assert match_rules("Bitcoin растёт", cm.get_compiled_rules()) == []
+
+def test_check_message_escapes_keywords():
+    """Спецсимволы regex в ключевых словах ищутся буквально"""
+    rules = [
+        {
+            'name': 'r1',
+            'keywords': ['c++', '1.5'],
+            'target_chat_ids': [-100],
+            'case_sensitive': False
+        }
+    ]
+
+    assert len(check_message_against_rules("Пишу на C++", rules)) == 1
+    assert check_message_against_rules("версия 105", rules) == []
+
+def test_compile_rules_lowercases_keywords_once():
+    """Ключевые слова нечувствительных к регистру правил приводятся к нижнему регистру при компиляции"""
+    from app.handlers import compile_rules, match_rules
+
+    compiled = compile_rules([
+        {'name': 'ci', 'keywords': ['Bitcoin'], 'target_chat_ids': [-100], 'case_sensitive': False},
+        {'name': 'cs', 'keywords': ['BTC'], 'target_chat_ids': [-200], 'case_sensitive': True},
+    ])
+    assert compiled[0].keywords == ('bitcoin',)
+    assert compiled[1].keywords == ('BTC',)
+
+    matched = match_rules("BITCOIN и BTC", compiled)
+    assert [r.rule_name for r in matched] == ['ci', 'cs']
+    # В отчёте ключевое слово в исходном написании
+    assert matched[0].matched_keyword == 'Bitcoin'
+
+def test_short_text_skips_rules():
+    """Текст короче самого короткого ключевого слова правила не проверяется"""
+    from app.handlers import compile_rules, match_rules
+
+    compiled = compile_rules([
+        {'name': 'long', 'keywords': ['bitcoin', 'ethereum'], 'target_chat_ids': [-100]},
+        {'name': 'dot', 'keywords': ['i̇'], 'target_chat_ids': [-200]},
+    ])
+    assert compiled[0].min_len == 7
+    assert match_rules("btc", compiled) == []
+
+    # 'İ'.lower() длиннее исходного символа - такое совпадение не теряется
+    assert [r.rule_name for r in match_rules("İ", compiled)] == ['dot']
@@ -3,14 +3,20 @@ from app.config_manager import ConfigManager
 import os
 import json
 
+RULES_CONTENT_BASIC = b"test_rule: keyword -> -3667194817\n"
+RULES_CONTENT_PROPER_IDS = (
+    b"rule1: k -> -1001234567890\n"
+    b"rule2: k -> 123456789\n"
+    b"rule3: k -> -123456789\n"
+)
+
 def test_id_auto_correction(tmp_path):
     """Тест автоматической коррекции ID чатов (добавление -100)"""
     config_file = tmp_path / "config.json"
     rules_file = tmp_path / "rules.txt"
     
     # Создаем rules.txt с "кривым" ID
-    rules_content = "test_rule: keyword -> -3667194817\n"
-    rules_file.write_text(rules_content)
+    rules_file.write_bytes(RULES_CONTENT_BASIC)
     
     # Инициализируем конфиг менеджер
     cm = ConfigManager(config_file=str(config_file), rules_file=str(rules_file))
@@ -27,12 +33,7 @@ def test_id_no_correction_for_proper_ids(tmp_path):
     rules_file = tmp_path / "rules.txt"
     
     # -100... и короткие ID (например, личные чаты) не должны меняться
-    rules_content = (
-        "rule1: k -> -1001234567890\n"
-        "rule2: k -> 123456789\n"
-        "rule3: k -> -123456789\n"
-    )
-    rules_file.write_text(rules_content)
+    rules_file.write_bytes(RULES_CONTENT_PROPER_IDS)
     
     cm = ConfigManager(config_file=str(config_file), rules_file=str(rules_file))
     cm.load()
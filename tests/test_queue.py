@@ -3,44 +3,36 @@ import pytest
 import json
 import asyncio
 from pathlib import Path
-from unittest.mock import AsyncMock, Mock, patch
+from unittest.mock import Mock, patch
 
 from telethon.errors import FloodWaitError, ChatIdInvalidError
 
-@pytest.fixture
-def queue_dir(tmp_path):
-    d = tmp_path / "queue"
-    d.mkdir()
-    return d
+from app.matching import MatchedRule
 
-@pytest.fixture
-def queue_mgr(queue_dir):
-    # Mock config manager
-    config_mgr = Mock()
-    from app.queue_manager import QueueManager
-    return QueueManager(config_mgr, str(queue_dir))
+class _FakeClient:
+    """Лёгкий клиент для успешных отправок: запоминает отправленные сообщения"""
+    def __init__(self):
+        self.sent = []
 
-@pytest.fixture
-def sample_message():
-    msg = Mock()
-    msg.id = 123
-    msg.chat_id = -100111
-    msg.text = "Test message"
-    return msg
+    async def get_input_entity(self, chat_id):
+        return chat_id
+
+    async def send_message(self, peer, text):
+        self.sent.append((peer, text))
+
+    async def forward_messages(self, peer, messages, from_peer):
+        self.sent.append((peer, messages))
 
 @pytest.fixture
-def mock_client():
-    client = AsyncMock()
-    # Mock get_input_entity to return something valid
-    client.get_input_entity.return_value = Mock()
-    return client
+def fake_client():
+    return _FakeClient()
 
 def test_add_to_queue(queue_mgr, sample_message):
     """Тест добавления сообщения в очередь"""
     data = {
         'message': sample_message,
         'target_chats': [-1001, -1002],
-        'matched_rules': [{'rule_name': 'test_rule'}],
+        'matched_rules': [MatchedRule('test_rule', 'test', [-1001, -1002])],
         'forward_mode': 'copy'
     }
     
@@ -93,23 +85,12 @@ def test_remove_from_queue(queue_mgr, sample_message):
     assert len(queue_mgr.get_queue_items()) == 0
 
 @pytest.mark.asyncio
-async def test_send_message_safe_success(queue_mgr, mock_client, sample_message):
+async def test_send_message_safe_success(queue_mgr, fake_client, msg_data):
     """Тест успешной отправки"""
-    data = {
-        'message': sample_message,
-        'target_chats': [-1001],
-        'matched_rules': [{'rule_name': 'r1'}],
-        'forward_mode': 'copy'
-    }
-    queue_mgr.add_to_queue(data)
-    items = queue_mgr.get_queue_items()
-    with open(items[0], 'r') as f:
-        msg_data = json.load(f)
-        
-    mock_client.send_message.return_value = None
+    msg_data['matched_rules'] = ['r1']
     
     success, error_type = await queue_mgr.send_message_safe(
-        mock_client,
+        fake_client,
         -1001,
         msg_data,
         'copy',
@@ -118,24 +99,14 @@ async def test_send_message_safe_success(queue_mgr, mock_client, sample_message)
     
     assert success is True
     assert error_type == 'none'
-    assert mock_client.send_message.call_count == 2 # Message + log
+    # В режиме copy уведомление о правиле отправляется тем же сообщением
+    assert fake_client.sent == [(-1001, "Test message\n\nℹ️ Сработало правило: r1")]
 
 @pytest.mark.asyncio
-async def test_send_message_safe_permanent_error(queue_mgr, mock_client, sample_message):
+async def test_send_message_safe_permanent_error(queue_mgr, mock_client, msg_data):
     """Тест постоянной ошибки (ChatIdInvalidError)"""
-    data = {
-        'message': sample_message,
-        'target_chats': [-1001],
-        'matched_rules': [],
-        'forward_mode': 'copy'
-    }
-    queue_mgr.add_to_queue(data)
-    items = queue_mgr.get_queue_items()
-    with open(items[0], 'r') as f:
-        msg_data = json.load(f)
-    
-    # Simulate ChatIdInvalidError
-    mock_client.get_input_entity.side_effect = ChatIdInvalidError(request=None)
+    # Simulate ChatIdInvalidError только на первом вызове
+    mock_client.get_input_entity.side_effect = [ChatIdInvalidError(request=None), Mock()]
 
     success, error_type = await queue_mgr.send_message_safe(
         mock_client,
@@ -145,21 +116,14 @@ async def test_send_message_safe_permanent_error(queue_mgr, mock_client, sample_
     
     assert success is False
     assert error_type == 'permanent'
+    
+    # Повторная попытка резолвит чат заново и проходит
+    success, error_type = await queue_mgr.send_message_safe(mock_client, -1001, msg_data)
+    assert (success, error_type) == (True, 'none')
 
 @pytest.mark.asyncio
-async def test_send_message_safe_temporary_error(queue_mgr, mock_client, sample_message):
+async def test_send_message_safe_temporary_error(queue_mgr, mock_client, msg_data):
     """Тест временной ошибки (FloodWait)"""
-    data = {
-        'message': sample_message,
-        'target_chats': [-1001],
-        'matched_rules': [],
-        'forward_mode': 'copy'
-    }
-    queue_mgr.add_to_queue(data)
-    items = queue_mgr.get_queue_items()
-    with open(items[0], 'r') as f:
-        msg_data = json.load(f)
-        
     # Simulate FloodWait
     error = FloodWaitError(request=None, capture=10)
     mock_client.get_input_entity.side_effect = error
@@ -171,6 +135,31 @@ async def test_send_message_safe_temporary_error(queue_mgr, mock_client, sample_
             msg_data
         )
 
+@pytest.mark.asyncio
+async def test_send_message_safe_error_classification(queue_mgr, mock_client, msg_data):
+    """PeerIdInvalid пропускает чат без блокировки, ServerError передаётся на повтор"""
+    from telethon.errors import PeerIdInvalidError, ServerError
+
+    mock_client.get_input_entity.side_effect = [PeerIdInvalidError(request=None), ServerError(None, 'INTERNAL')]
+
+    result = await queue_mgr.send_message_safe(mock_client, -1001, msg_data)
+    assert result == (False, 'permanent')
+    queue_mgr.config_mgr.block_target.assert_not_called()
+
+    with pytest.raises(ServerError):
+        await queue_mgr.send_message_safe(mock_client, -1001, msg_data)
+
+@pytest.mark.asyncio
+async def test_send_message_safe_account_ban_not_blocking(queue_mgr, mock_client, msg_data):
+    """Ограничение аккаунта (UserBannedInChannel) пропускает отправку, но не блокирует чат"""
+    from telethon.errors import UserBannedInChannelError
+
+    mock_client.send_message.side_effect = UserBannedInChannelError(request=None)
+
+    result = await queue_mgr.send_message_safe(mock_client, -1001, msg_data)
+    assert result == (False, 'permanent')
+    queue_mgr.config_mgr.block_target.assert_not_called()
+
 def test_move_to_failed(queue_mgr, sample_message):
     """Тест перемещения в failed"""
     data = {
@@ -189,3 +178,217 @@ def test_move_to_failed(queue_mgr, sample_message):
     assert len(failed_items) == 1
     assert failed_items[0].name == items[0].name
 
+
+@pytest.mark.asyncio
+async def test_send_message_safe_caches_entities(queue_mgr, mock_client):
+    """Сущность чата резолвится один раз и сбрасывается после постоянной ошибки"""
+    msg_data = {'message_id': 1, 'from_chat_id': -100111, 'message_text': 'hi'}
+
+    for _ in range(3):
+        success, _ = await queue_mgr.send_message_safe(mock_client, -1001, msg_data, 'forward')
+        assert success is True
+
+    # По одному разу для целевого и исходного чатов
+    assert mock_client.get_input_entity.call_count == 2
+
+    mock_client.forward_messages.side_effect = ChatIdInvalidError(request=None)
+    success, error_type = await queue_mgr.send_message_safe(mock_client, -1001, msg_data, 'forward')
+    assert (success, error_type) == (False, 'permanent')
+    assert -1001 not in queue_mgr._entity_cache
+
+def test_get_queue_items_limit(queue_mgr):
+    """Возвращаются самые старые файлы в порядке времени"""
+    for ts in (300, 100, 200):
+        (queue_mgr.queue_dir / f"{ts}.json").write_text('{}')
+    (queue_mgr.queue_dir / "400.json.tmp").write_text('{}')
+
+    assert [p.name for p in queue_mgr.get_queue_items()] == ['100.json', '200.json', '300.json']
+    assert [p.name for p in queue_mgr.get_queue_items(2)] == ['100.json', '200.json']
+
+@pytest.mark.asyncio
+async def test_process_queue_sends_targets_concurrently(queue_mgr, mock_client, sample_message):
+    """Отправки в разные чаты идут параллельно, постоянная ошибка не блокирует остальные"""
+    active = 0
+    peak = 0
+
+    async def slow_get_entity(chat_id):
+        nonlocal active, peak
+        active += 1
+        peak = max(peak, active)
+        await asyncio.sleep(0.01)
+        active -= 1
+        if chat_id == -1003:
+            raise ChatIdInvalidError(request=None)
+        return Mock()
+
+    mock_client.get_input_entity.side_effect = slow_get_entity
+
+    queue_mgr.add_to_queue({
+        'message': sample_message,
+        'target_chats': [-1001, -1002, -1003],
+        'matched_rules': [],
+        'forward_mode': 'copy'
+    })
+
+    worker = asyncio.create_task(queue_mgr.process_queue(mock_client))
+    for _ in range(100):
+        await asyncio.sleep(0.01)
+        if not queue_mgr.get_queue_items():
+            break
+    worker.cancel()
+
+    assert queue_mgr.get_queue_items() == []
+    assert peak == 3
+    assert mock_client.send_message.call_count == 2
+
+@pytest.mark.asyncio
+async def test_rate_limiter_spreads_bursts():
+    """Token bucket пропускает max_rate операций сразу, остальные - по мере пополнения"""
+    from app.queue_manager import RateLimiter
+
+    limiter = RateLimiter(2, 0.1)
+    loop = asyncio.get_running_loop()
+    start = loop.time()
+
+    for _ in range(2):
+        async with limiter:
+            pass
+    assert loop.time() - start < 0.04
+
+    for _ in range(2):
+        async with limiter:
+            pass
+    assert loop.time() - start >= 0.09
+
+@pytest.mark.asyncio
+async def test_process_queue_wakes_on_add(queue_mgr, mock_client, sample_message):
+    """Простаивающий worker просыпается сразу после add_to_queue"""
+    worker = asyncio.create_task(queue_mgr.process_queue(mock_client))
+    await asyncio.sleep(0.01)
+
+    queue_mgr.add_to_queue({
+        'message': sample_message,
+        'target_chats': [-1001],
+        'matched_rules': [],
+        'forward_mode': 'copy'
+    })
+    for _ in range(50):
+        await asyncio.sleep(0.01)
+        if not queue_mgr.get_queue_items():
+            break
+    worker.cancel()
+
+    assert queue_mgr.get_queue_items() == []
+    mock_client.send_message.assert_called_once()
+
+@pytest.mark.asyncio
+async def test_process_queue_resumes_from_sent_log(queue_mgr, mock_client, sample_message):
+    """Чаты из журнала прерванного прохода не получают сообщение повторно"""
+    import struct
+
+    queue_mgr.add_to_queue({
+        'message': sample_message,
+        'target_chats': [-1001, -1002],
+        'matched_rules': [],
+        'forward_mode': 'copy'
+    })
+    item = queue_mgr.get_queue_items()[0]
+    # Журнал с неполной записью в конце, как после сбоя во время записи
+    item.with_suffix('.sent').write_bytes(struct.pack('<q', -1001) + b'\x00\x01')
+
+    worker = asyncio.create_task(queue_mgr.process_queue(mock_client))
+    for _ in range(50):
+        await asyncio.sleep(0.01)
+        if not item.exists():
+            break
+    worker.cancel()
+
+    assert not item.exists()
+    assert not item.with_suffix('.sent').exists()
+    mock_client.get_input_entity.assert_called_once_with(-1002)
+
+@pytest.mark.asyncio
+async def test_sent_log_kept_when_save_fails(queue_mgr, mock_client, sample_message, monkeypatch):
+    """Если JSON элемента не записался, журнал доставок не удаляется"""
+    queue_mgr.add_to_queue({
+        'message': sample_message,
+        'target_chats': [-1001, -1002],
+        'matched_rules': [],
+        'forward_mode': 'copy'
+    })
+    item = queue_mgr.get_queue_items()[0]
+    
+    async def get_entity(chat_id):
+        if chat_id == -1002:
+            raise ConnectionError("network down")
+        return Mock()
+    
+    mock_client.get_input_entity.side_effect = get_entity
+    monkeypatch.setattr(queue_mgr, '_save_queue_item', lambda filename, data: False)
+    
+    worker = asyncio.create_task(queue_mgr.process_queue(mock_client))
+    for _ in range(50):
+        await asyncio.sleep(0.01)
+        if mock_client.get_input_entity.call_count >= 2:
+            break
+    await asyncio.sleep(0.05)
+    worker.cancel()
+    
+    assert queue_mgr._read_sent_log(item) == {-1001}
+
+def test_add_to_queue_unique_files(queue_mgr, sample_message):
+    """Сообщения, добавленные подряд, не перезаписывают друг друга"""
+    data = {
+        'message': sample_message,
+        'target_chats': [-1001],
+        'matched_rules': [],
+        'forward_mode': 'copy'
+    }
+    with patch('app.queue_manager.time.time_ns', return_value=1_700_000_000_000_000_000):
+        for _ in range(3):
+            queue_mgr.add_to_queue(data)
+
+    names = [p.name for p in queue_mgr.get_queue_items()]
+    assert names == ['1700000000000000.json', '1700000000000001.json', '1700000000000002.json']
+
+@pytest.mark.asyncio
+async def test_send_message_safe_long_text_separate_notice(queue_mgr, mock_client):
+    """Если уведомление не помещается в лимит, оно уходит отдельным сообщением"""
+    from app.queue_manager import TELEGRAM_MESSAGE_LIMIT
+
+    msg_data = {'message_id': 1, 'from_chat_id': -100111, 'message_text': 'x' * TELEGRAM_MESSAGE_LIMIT}
+    success, _ = await queue_mgr.send_message_safe(mock_client, -1001, msg_data, 'copy', ['r1'])
+
+    assert success is True
+    assert mock_client.send_message.call_count == 2
+    assert mock_client.send_message.call_args_list[0][0][1] == msg_data['message_text']
+
+@pytest.mark.asyncio
+async def test_send_message_safe_blocks_forbidden_chat(queue_mgr, mock_client):
+    """Запрет записи блокирует чат, заблокированный чат пропускается без API"""
+    from telethon.errors import ChatWriteForbiddenError
+
+    msg_data = {'message_id': 1, 'from_chat_id': -100111, 'message_text': 'hi'}
+    mock_client.send_message.side_effect = ChatWriteForbiddenError(request=None)
+
+    result = await queue_mgr.send_message_safe(mock_client, -1001, msg_data, 'copy')
+    assert result == (False, 'permanent')
+    queue_mgr.config_mgr.block_target.assert_called_once_with(-1001)
+
+    queue_mgr.config_mgr.is_blocked_target.return_value = True
+    calls = mock_client.get_input_entity.call_count
+    result = await queue_mgr.send_message_safe(mock_client, -1001, msg_data, 'copy')
+    assert result == (False, 'permanent')
+    assert mock_client.get_input_entity.call_count == calls
+
+def test_save_queue_item_is_atomic(queue_mgr, sample_message):
+    """Элемент очереди записывается через временный файл, который не остаётся в очереди"""
+    queue_mgr.add_to_queue({
+        'message': sample_message,
+        'target_chats': [-1001],
+        'matched_rules': [],
+        'forward_mode': 'copy'
+    })
+
+    files = sorted(p.name for p in queue_mgr.queue_dir.iterdir())
+    assert len(files) == 1 and files[0].endswith('.json')